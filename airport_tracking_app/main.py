@@ -6,9 +6,10 @@ from kivy.modules import inspector
 from kivy.core.window import Window
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button, Label
-from sqlalchemy.exc import SQLAlchemyError, MultipleResultsFound
-from database import Airport, City, Condition, Database, Itinerary
-from rest import RESTConnection
+from sqlalchemy.exc import SQLAlchemyError, MultipleResultsFound, NoResultFound
+from sqlalchemy.orm import selectinload
+from database import Airport, City, Condition, Database, Itinerary, profiled, forecast_rows, upsert_forecasts
+from rest import RESTConnection, ForecastCache
 from datetime import date
 
 
@@ -48,11 +49,14 @@ class AirportApp(App):
         self.api_key = data['api_key']
         self.updated_forecast = None
         self.weather_connection = None
-        self.connect_to_open_weather(port_api=443)
+        self.forecast_cache = None
+        self.connect_to_open_weather(data.get('api_port', 443), data.get('api_authority', 'api.openweathermap.org'),
+                                     data.get('api_secure', True))
 
     def build(self):
         inspector.create_inspector(Window, self)
 
+    @profiled
     def submit_data_airport(self, name, code, latitude, longitude):
         if len(name) > 0 and len(code) > 0 and len(latitude) > 0 and len(longitude) > 0:
             try:
@@ -60,6 +64,7 @@ class AirportApp(App):
                 self.set_current_airport(name)
                 self.root.current = 'success_airport'
             except SQLAlchemyError:
+                self.session.rollback()
                 self.root.ids.create_airport_error.text = 'Database could not be updated.' \
                                                           '\nThe information added may match an airport that' \
                                                           '\nis currently in the database'
@@ -73,6 +78,7 @@ class AirportApp(App):
         self.session.add(airport)
         self.session.commit()
 
+    @profiled
     def submit_data_city(self, name, geographic_entity, latitude, longitude):
         if len(name) > 0 and len(geographic_entity) > 0 and len(latitude) > 0 and len(longitude) > 0:
             try:
@@ -80,6 +86,7 @@ class AirportApp(App):
                 self.set_current_city(name)
                 self.root.current = 'success_city'
             except SQLAlchemyError:
+                self.session.rollback()
                 self.root.ids.create_city_error.text = 'Database could not be updated.' \
                                                        '\nThe information added may match a city that' \
                                                        '\nis currently in the database.'
@@ -98,6 +105,7 @@ class AirportApp(App):
         values = [airport.name for airport in self.session.query(Airport).all()]
         self.root.ids.forecast_spinner.values = values
 
+    @profiled
     def add_forecast(self, airport_name, date_1):
         try:
             airport = self.session.query(Airport).filter(Airport.name == airport_name).one()
@@ -143,8 +151,11 @@ class AirportApp(App):
             self.root.current = 'check_forecast'
             self.root.ids.check_forecast_error.text = 'No airport was selected'
 
-    def connect_to_open_weather(self, port_api=443):
-        self.weather_connection = RESTConnection('api.openweathermap.org', port_api, '/data/2.5')
+    def connect_to_open_weather(self, port_api=443, authority='api.openweathermap.org', secure=True):
+        if self.forecast_cache is None:
+            self.forecast_cache = ForecastCache('forecast_cache')
+        self.weather_connection = RESTConnection(authority, port_api, '/data/2.5', cache=self.forecast_cache,
+                                                 secure=secure)
 
     def request_onecall_for_place(self, latitude, longitude, api_key, airport):
         self.weather_connection.send_request(
@@ -168,18 +179,8 @@ class AirportApp(App):
         self.updated_forecast = response
 
     def create_new_forecasts(self, airport):
-        for day in self.updated_forecast['daily']:
-            max_temperature = int(day['temp']['max'])
-            min_temperature = int(day['temp']['min'])
-            humidity = int(day['humidity'])
-            wind_speed = int(day['wind_speed'])
-            visibility = 10
-            rain = int(day['pop'])
-            forecast = Condition(date=date.fromtimestamp(int(day['dt'])), max_temperature=max_temperature,
-                                 min_temperature=min_temperature, max_humidity=humidity, max_wind_speed=wind_speed,
-                                 visibility=visibility, rain=rain, airport=airport)
-            self.session.add(forecast)
-            self.session.commit()
+        upsert_forecasts(self.session, airport, forecast_rows(self.updated_forecast))
+        self.session.commit()
 
     def add_buttons(self):
         airports = self.session.query(Airport).all()
@@ -189,6 +190,7 @@ class AirportApp(App):
         for city in cities:
             self.root.ids.scroll_box_1.add_widget(CityButtons(text=city.city_name))
 
+    @profiled
     def add_itineraries(self, selected_itinerary_text):
         try:
             self.root.ids.past_itineraries.clear_widgets()
@@ -198,22 +200,26 @@ class AirportApp(App):
             if selected_itinerary_text is not None:
                 _, _, city_name = selected_itinerary_text.partition('City: ')
                 city_name, _, _ = city_name.partition('\n')
-                selected_itinerary = self.session.query(Itinerary).filter(Itinerary.city == city_name).one()
+                selected_itinerary = self.session.query(Itinerary).join(Itinerary.city).filter(
+                    City.city_name == city_name).one()
                 next_city = city_name
                 self.update_select_itinerary(True, selected_itinerary)
-            itineraries = self.session.query(Itinerary).order_by(Itinerary.date)
+            itineraries = self.session.query(Itinerary).options(
+                selectinload(Itinerary.city), selectinload(Itinerary.venues)).order_by(Itinerary.date)
             today_date = date.today()
             day_count = 1
             current_location = None
             for itinerary in itineraries:
-                itinerary_text = f'City: {itinerary.city}\nVenues: '
+                # The city of an itinerary is cleared when the city is deleted; such a day is listed but not offered.
+                city_name = itinerary.city.city_name if itinerary.city is not None else 'Unknown'
+                itinerary_text = f'City: {city_name}\nVenues: '
                 for venue in itinerary.venues:
                     itinerary_text += f'{venue.venue_name}({venue.venue_type}), '
                 if selected_itinerary is not None and itinerary.date == selected_itinerary.date and itinerary != selected_itinerary:
                     self.update_select_itinerary(False, itinerary)
                 if itinerary.itinerary_type == 'Past' or itinerary.selected:
                     if not itinerary.selected:
-                        current_location = itinerary.city
+                        current_location = city_name
                     time_difference = itinerary.date - today_date
                     day_count = str(time_difference)
                     day_count, _, _ = day_count.partition(' day')
@@ -222,10 +228,10 @@ class AirportApp(App):
                     else:
                         day_count = str(int(day_count)+1)
                     if itinerary.selected:
-                        next_city = itinerary.city
+                        next_city = city_name
                         self.root.ids.selected_itinerary.text = 'Next ' + itinerary_text
                     self.root.ids.past_itineraries.add_widget(ItineraryLabel(text=f'Day #{day_count}: {itinerary.date}\n' + itinerary_text))
-                else:
+                elif itinerary.city is not None:
                     if itinerary.itinerary_type == 'Close':
                         self.root.ids.proposed_itineraries.add_widget(ItineraryLabel(text='Closest\nto Destination'))
                     else:
@@ -234,6 +240,8 @@ class AirportApp(App):
             self.root.ids.current_status.text = f'Day #{day_count}\nCurrent City: {current_location}\nNext City: {next_city}'
         except MultipleResultsFound:
             self.root.ids.itinerary_error_message.text = 'There seems to be multiple of the same values in the database'
+        except NoResultFound:
+            self.root.ids.itinerary_error_message.text = "The selected itinerary's city is no longer in the database"
 
     def update_select_itinerary(self, selected, itinerary):
         itinerary.selected = selected
@@ -64,9 +64,12 @@ class TestAirport(unittest.TestCase):
         database.ensure_tables_exist()
         test_app = AirportApp()
         test_app.session = database.create_session()
-        test_itinerary = Itinerary(airport='JFK', city='New York City', selected=False)
+        test_city = City(city_name='New York City', latitude=40.7, longitude=-74.0,
+                         encompassing_geographic_entity='United States')
+        test_itinerary = Itinerary(airport=Airport(name='JFK', cities=[test_city]), city=test_city, selected=False)
         test_app.update_select_itinerary(True, test_itinerary)
-        actual = test_app.session.query(Itinerary).filter(Itinerary.city == 'New York City').one()
+        actual = test_app.session.query(Itinerary).join(Itinerary.city).filter(
+            City.city_name == 'New York City').one()
         self.assertEqual(actual.selected, True)
 
 
@@ -6,7 +6,8 @@ from kivy.core.window import Window  # For inspection.
 import json
 
 from kivy.uix.button import Button, Label
-from sqlalchemy.exc import MultipleResultsFound
+from sqlalchemy.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.orm import selectinload
 
 from database import *
 
@@ -62,6 +63,7 @@ class EntertainmentTrackerApp(App):
             venue_names.append(str(venue.venue_name))
         self.root.ids.venue_edit_selection.values = venue_names
 
+    @profiled
     def add_city(self, name, lat, long, entity):
         # Search for cities with the exact same name
         query = self.session.query(City).filter(City.city_name == name)
@@ -93,16 +95,16 @@ class EntertainmentTrackerApp(App):
         return query.count() > 0
 
     def duplicate_name_venue(self, original_name, candidate_name, city_selection, create_or_edit):
+        # Venue names are unique across every city, since the other apps look venues up by name alone.
         duplicate_name = False
-        city = self.session.query(City).filter(City.city_name == city_selection).one()
-        venues_to_check = city.venues
-        for venue in venues_to_check:
-            if create_or_edit == 'CREATE' and venue.venue_name == candidate_name:
+        query = self.session.query(Venue).filter(Venue.venue_name == candidate_name)
+        if query.count() > 0:
+            if create_or_edit == 'CREATE':
                 duplicate_name = True
-                self.root.ids.venue_name_error.text = f'A venue under the name {candidate_name} already exists in the chosen city.'
-            if create_or_edit == 'EDIT' and venue.venue_name == candidate_name and original_name != candidate_name:
+                self.root.ids.venue_name_error.text = f'A venue under the name {candidate_name} already exists.'
+            if create_or_edit == 'EDIT' and original_name != candidate_name:
                 duplicate_name = True
-                self.root.ids.venue_edit_message.text = f'A venue under the name {candidate_name} already exists in the chosen city.'
+                self.root.ids.venue_edit_message.text = f'A venue under the name {candidate_name} already exists.'
         return duplicate_name
 
     def check_city_for_venues(self, city, edit_or_review):
@@ -122,6 +124,7 @@ class EntertainmentTrackerApp(App):
             else:
                 self.root.ids.no_venues_to_review.text = message
 
+    @profiled
     def add_venue(self, ven_name, ven_type, city_name, min_temp, max_temp, min_humidity, max_humidity, max_wind_speed,
                   weather_condition_code):
         self.root.ids.venue_edit_selection.values.append(ven_name)
@@ -161,6 +164,7 @@ class EntertainmentTrackerApp(App):
             self.session.commit()
             return True
 
+    @profiled
     def update_venue_data(self, name, new_name, city, new_min_t, new_max_t, new_min_h, new_max_h, new_max_w, new_owc):
         venue_updated_successfully = self._update_venue_data(name, new_name, city, new_min_t, new_max_t, new_min_h,
                                                              new_max_h, new_max_w, new_owc)
@@ -241,6 +245,7 @@ class EntertainmentTrackerApp(App):
         else:
             self.root.ids.open_weather_conditions.opacity = 1
 
+    @profiled
     def add_welp_score(self, review_score, venue_being_reviewed):
         valid_score = self._add_welp_score(review_score, venue_being_reviewed)
         if valid_score:
@@ -264,6 +269,7 @@ class EntertainmentTrackerApp(App):
             return True
         return False
 
+    @profiled
     def add_itineraries(self, selected_itinerary_text):
         try:
             self.root.ids.past_itineraries.clear_widgets()
@@ -273,22 +279,26 @@ class EntertainmentTrackerApp(App):
             if selected_itinerary_text is not None:
                 _, _, city_name = selected_itinerary_text.partition('City: ')
                 city_name, _, _ = city_name.partition('\n')
-                selected_itinerary = self.session.query(Itinerary).filter(Itinerary.city == city_name).one()
+                selected_itinerary = self.session.query(Itinerary).join(Itinerary.city).filter(
+                    City.city_name == city_name).one()
                 next_city = city_name
                 self.update_select_itinerary(True, selected_itinerary)
-            itineraries = self.session.query(Itinerary).order_by(Itinerary.date)
+            itineraries = self.session.query(Itinerary).options(
+                selectinload(Itinerary.city), selectinload(Itinerary.venues)).order_by(Itinerary.date)
             today_date = date.today()
             day_count = 1
             current_location = None
             for itinerary in itineraries:
-                itinerary_text = f'City: {itinerary.city}\nVenues: '
+                # The city of an itinerary is cleared when the city is deleted; such a day is listed but not offered.
+                city_name = itinerary.city.city_name if itinerary.city is not None else 'Unknown'
+                itinerary_text = f'City: {city_name}\nVenues: '
                 for venue in itinerary.venues:
                     itinerary_text += f'{venue.venue_name}({venue.venue_type}), '
                 if selected_itinerary is not None and itinerary.date == selected_itinerary.date and itinerary != selected_itinerary:
                     self.update_select_itinerary(False, itinerary)
                 if itinerary.itinerary_type == 'Past' or itinerary.selected:
                     if not itinerary.selected:
-                        current_location = itinerary.city
+                        current_location = city_name
                     time_difference = itinerary.date - today_date
                     day_count = str(time_difference)
                     day_count, _, _ = day_count.partition(' day')
@@ -297,10 +307,10 @@ class EntertainmentTrackerApp(App):
                     else:
                         day_count = str(int(day_count)+1)
                     if itinerary.selected:
-                        next_city = itinerary.city
+                        next_city = city_name
                         self.root.ids.selected_itinerary.text = 'Next ' + itinerary_text
                     self.root.ids.past_itineraries.add_widget(ItineraryLabel(text=f'Day #{day_count}: {itinerary.date}\n' + itinerary_text))
-                else:
+                elif itinerary.city is not None:
                     if itinerary.itinerary_type == 'Close':
                         self.root.ids.proposed_itineraries.add_widget(ItineraryLabel(text='Closest\nto Destination'))
                     else:
@@ -309,6 +319,8 @@ class EntertainmentTrackerApp(App):
             self.root.ids.current_status.text = f'Day #{day_count}\nCurrent City: {current_location}\nNext City: {next_city}'
         except MultipleResultsFound:
             self.root.ids.itinerary_error_message.text = 'There seems to be multiple of the same values in the database'
+        except NoResultFound:
+            self.root.ids.itinerary_error_message.text = "The selected itinerary's city is no longer in the database"
 
     def update_select_itinerary(self, selected, itinerary):
         itinerary.selected = selected
@@ -1,12 +1,41 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Float, Date, Boolean
+import functools
+import hashlib
+import heapq
+import logging
+import math
+import os
+import random
+import threading
+import time
+from datetime import date
+from contextlib import contextmanager, nullcontext
+from sqlalchemy import create_engine, event, select, text, Column, Integer, String, ForeignKey, Float, Date, Boolean, \
+    Index
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from sqlalchemy.orm.attributes import set_committed_value
 
 Persisted = declarative_base()
 
+EARTH_RADIUS = 6371
+MAX_FLIGHT_DISTANCE = 3500
+SLOWEST_STATEMENT_COUNT = 5
+FORECAST_VALUE_COLUMNS = ['min_temperature', 'max_temperature', 'max_humidity', 'max_wind_speed', 'visibility', 'rain']
+# Tables whose every insert, update and delete bumps a counter in table_versions, whichever app or statement makes it.
+# Forecasts are counted apart from venue requirements and city forecasts, since only the former concern airports.
+VERSIONED_TABLES = ['airports', 'cities', 'venues', 'conditions', 'airport_cities', 'city_venues', 'venue_conditions']
+TABLE_VERSION_NAMES = ['airports', 'cities', 'venues', 'airport_conditions', 'city_conditions', 'airport_cities',
+                       'city_venues', 'venue_conditions']
+
 
 class City(Persisted):
     __tablename__ = 'cities'
+    __table_args__ = (
+        Index('ix_cities_city_name', 'city_name', unique=True),
+    )
     city_id = Column(Integer, primary_key=True, autoincrement=True)
     city_name = Column(String(256), nullable=False)
     latitude = Column(Float, nullable=False)
@@ -20,6 +49,10 @@ class City(Persisted):
 
 class Venue(Persisted):
     __tablename__ = 'venues'
+    __table_args__ = (
+        Index('ix_venues_venue_name', 'venue_name', unique=True),
+        Index('ix_venues_venue_type', 'venue_type'),
+    )
     venue_id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
     venue_name = Column(String(256), nullable=False)
     venue_type = Column(String(256), nullable=False)
@@ -45,6 +78,9 @@ class ItineraryVenue(Persisted):
 
 class Review(Persisted):
     __tablename__ = 'reviews'
+    __table_args__ = (
+        Index('ix_reviews_validated_venue_id', 'validated', 'venue_id'),
+    )
     review_id = Column(Integer, primary_key=True, autoincrement=True)
     venue_id = Column(Integer, ForeignKey('venues.venue_id', ondelete='CASCADE'))
     score = Column(Integer, nullable=False)
@@ -54,6 +90,10 @@ class Review(Persisted):
 
 class Condition(Persisted):
     __tablename__ = 'conditions'
+    __table_args__ = (
+        Index('ix_conditions_city_id_date', 'city_id', 'date', unique=True),
+        Index('ix_conditions_airport_id_date', 'airport_id', 'date', unique=True),
+    )
     condition_id = Column(Integer, primary_key=True, autoincrement=True)
     city_id = Column(Integer, ForeignKey('cities.city_id', ondelete='CASCADE'))
     airport_id = Column(Integer, ForeignKey('airports.airport_id', ondelete='CASCADE'))
@@ -71,6 +111,44 @@ class Condition(Persisted):
     city = relationship('City', back_populates='conditions')
 
 
+def forecast_rows(response):
+    # One row per daily entry of an OpenWeather onecall response, in the form upsert_forecasts writes.
+    return [{
+        'date': date.fromtimestamp(int(day['dt'])),
+        'max_temperature': int(day['temp']['max']),
+        'min_temperature': int(day['temp']['min']),
+        'max_humidity': int(day['humidity']),
+        'max_wind_speed': int(day['wind_speed']),
+        'visibility': 10,
+        'rain': int(day['pop'])
+    } for day in response['daily']]
+
+
+def upsert_forecasts(session, place, rows):
+    # Writes all of a city's or airport's forecasts in one statement, overwriting any already stored for a day.
+    place_column = 'city_id' if isinstance(place, City) else 'airport_id'
+    place_id = place.city_id if isinstance(place, City) else place.airport_id
+    if place_id is None:
+        session.flush()
+        place_id = place.city_id if isinstance(place, City) else place.airport_id
+    if rows:
+        table = Condition.__table__
+        if session.get_bind().dialect.name == 'mysql':
+            statement = mysql_insert(table)
+            statement = statement.on_duplicate_key_update(
+                {column: statement.inserted[column] for column in FORECAST_VALUE_COLUMNS})
+        else:
+            statement = sqlite_insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[place_column, 'date'],
+                set_={column: statement.excluded[column] for column in FORECAST_VALUE_COLUMNS})
+        session.execute(statement, [dict(row, **{place_column: place_id}) for row in rows])
+    # The statement bypasses the identity map, so the place's forecasts are read back to keep loaded objects current.
+    forecasts = session.query(Condition).filter(getattr(Condition, place_column) == place_id).populate_existing().all()
+    set_committed_value(place, 'conditions', forecasts)
+    return forecasts
+
+
 class VenueCondition(Persisted):
     __tablename__ = 'venue_conditions'
     venue_id = Column(Integer, ForeignKey('venues.venue_id', ondelete='CASCADE'), primary_key=True)
@@ -79,6 +157,9 @@ class VenueCondition(Persisted):
 
 class Airport(Persisted):
     __tablename__ = 'airports'
+    __table_args__ = (
+        Index('ix_airports_name', 'name', unique=True),
+    )
     airport_id = Column(Integer, primary_key=True)
     name = Column(String(256), nullable=False)
     code = Column(String(256))
@@ -95,19 +176,298 @@ class AirportCity(Persisted):
     city_id = Column(Integer, ForeignKey('cities.city_id', ondelete='CASCADE'), primary_key=True)
 
 
+class AirportRoute(Persisted):
+    __tablename__ = 'airport_routes'
+    from_airport_id = Column(Integer, ForeignKey('airports.airport_id', ondelete='CASCADE'), primary_key=True)
+    to_airport_id = Column(Integer, ForeignKey('airports.airport_id', ondelete='CASCADE'), primary_key=True)
+    distance = Column(Float, nullable=False)
+
+
+class TableVersion(Persisted):
+    __tablename__ = 'table_versions'
+    table_name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+def table_version_name(table_name, row):
+    if table_name == 'conditions':
+        return f"CASE WHEN {row}.airport_id IS NULL THEN 'city_conditions' ELSE 'airport_conditions' END"
+    return f"'{table_name}'"
+
+
+def version_trigger_statement(dialect_name, table_name, operation):
+    rows = {'INSERT': ['NEW'], 'UPDATE': ['NEW', 'OLD'], 'DELETE': ['OLD']}[operation]
+    names = ', '.join(table_version_name(table_name, row) for row in rows)
+    update = f'UPDATE table_versions SET version = version + 1 WHERE table_name IN ({names})'
+    trigger = f'CREATE TRIGGER {table_name}_{operation.lower()}_version AFTER {operation} ON {table_name} FOR EACH ROW'
+    # SQLite wants the trigger body in BEGIN ... END, while MySQL takes a single statement as it is.
+    if dialect_name == 'sqlite':
+        return f'{trigger} BEGIN {update}; END'
+    return f'{trigger} {update}'
+
+
+def table_versions(session, names):
+    # The counters for the named tables, or None when the database has no triggers keeping them, so that nothing
+    # is trusted to be unchanged.
+    versions = dict(session.execute(select(TableVersion.table_name, TableVersion.version).where(
+        TableVersion.table_name.in_(names))).all())
+    if len(versions) < len(names):
+        return None
+    return tuple(versions[name] for name in names)
+
+
+def versioned_rows(name):
+    # The rows a table_versions counter counts the writes to, in a fixed order.
+    if name in ('airport_conditions', 'city_conditions'):
+        table = Condition.__table__
+        counted = table.c.airport_id.isnot(None) if name == 'airport_conditions' else table.c.airport_id.is_(None)
+        return select(table).where(counted).order_by(*table.primary_key.columns)
+    table = Persisted.metadata.tables[name]
+    return select(table).order_by(*table.primary_key.columns)
+
+
+def table_fingerprint(session, names):
+    # Changes with every write to the named tables, whoever makes it. It hashes their table_versions counters, or,
+    # when the installer could not add the triggers that keep them, every row of the tables, which reads them all.
+    digest = hashlib.sha256()
+    versions = table_versions(session, names)
+    if versions is not None:
+        digest.update(repr(versions).encode('UTF8'))
+        return digest.hexdigest()
+    for name in names:
+        digest.update(name.encode('UTF8'))
+        for row in session.execute(versioned_rows(name)):
+            digest.update(repr(tuple(row)).encode('UTF8'))
+    return digest.hexdigest()
+
+
+def great_circle_distance(current_latitude, current_longitude, next_latitude, next_longitude):
+    half_chord = math.sin(math.radians(next_latitude - current_latitude) / 2) ** 2 + \
+        math.cos(math.radians(current_latitude)) * math.cos(math.radians(next_latitude)) * \
+        math.sin(math.radians(next_longitude - current_longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, half_chord)))
+
+
+@event.listens_for(Session, 'after_flush')
+def add_airport_routes(session, _):
+    # Links the airports a flush inserted to every airport within flying range, in both directions. The airports are
+    # read once per flush, however many of them were inserted together.
+    new_airports = [item for item in session.new
+                    if isinstance(item, Airport) and item.latitude is not None and item.longitude is not None]
+    if not new_airports:
+        return
+    new_airport_ids = {airport.airport_id for airport in new_airports}
+    connection = session.connection()
+    linked_routes = set(connection.execute(select(AirportRoute.from_airport_id, AirportRoute.to_airport_id).where(
+        AirportRoute.from_airport_id.in_(new_airport_ids))).all())
+    other_airports = connection.execute(select(Airport.airport_id, Airport.latitude, Airport.longitude).where(
+        Airport.latitude.isnot(None), Airport.longitude.isnot(None))).all()
+    routes = []
+    for airport in new_airports:
+        latitude = float(airport.latitude)
+        longitude = float(airport.longitude)
+        for other_airport_id, other_latitude, other_longitude in other_airports:
+            # A pair of new airports is linked once, from the one with the lower id.
+            if other_airport_id == airport.airport_id or (airport.airport_id, other_airport_id) in linked_routes or \
+                    other_airport_id in new_airport_ids and other_airport_id < airport.airport_id:
+                continue
+            distance = great_circle_distance(latitude, longitude, other_latitude, other_longitude)
+            if distance <= MAX_FLIGHT_DISTANCE:
+                routes.append({'from_airport_id': airport.airport_id, 'to_airport_id': other_airport_id,
+                               'distance': distance})
+                routes.append({'from_airport_id': other_airport_id, 'to_airport_id': airport.airport_id,
+                               'distance': distance})
+    if routes:
+        connection.execute(AirportRoute.__table__.insert(), routes)
+
+
 class Itinerary(Persisted):
     __tablename__ = 'itineraries'
+    __table_args__ = (
+        Index('ix_itineraries_date', 'date'),
+    )
     itinerary_id = Column(Integer, primary_key=True, autoincrement=True)
-    airport = Column(String(256))
-    airport_left_from = Column(String(256))
-    city = Column(String(256))
+    # Deleting a place keeps the itineraries that visited it, as history, without the place.
+    airport_id = Column(Integer, ForeignKey('airports.airport_id', ondelete='SET NULL'))
+    airport_left_from_id = Column(Integer, ForeignKey('airports.airport_id', ondelete='SET NULL'))
+    city_id = Column(Integer, ForeignKey('cities.city_id', ondelete='SET NULL'))
     date = Column(Date)
     itinerary_type = Column(String(256))
-    next_itinerary = Column(String(256))
+    next_itinerary_id = Column(Integer, ForeignKey('itineraries.itinerary_id', ondelete='SET NULL'))
+    airport = relationship('Airport', foreign_keys=[airport_id])
+    airport_left_from = relationship('Airport', foreign_keys=[airport_left_from_id])
+    city = relationship('City')
+    next_itinerary = relationship('Itinerary', remote_side=[itinerary_id], post_update=True)
     venues = relationship('Venue', uselist=True, secondary='itinerary_venues', back_populates='itineraries')
     selected = Column(Boolean, default=False)
 
 
+class OperationStatistics(object):
+    def __init__(self, name, slowest_count=SLOWEST_STATEMENT_COUNT):
+        self.name = name
+        self.slowest_count = slowest_count
+        self.calls = 0
+        self.statement_count = 0
+        self.total_time = 0
+        self.slowest_statements = []
+
+    def record(self, statement, elapsed):
+        self.statement_count += 1
+        self.total_time += elapsed
+        # A min-heap of the slowest statements, so the fastest of them is the one replaced.
+        if len(self.slowest_statements) < self.slowest_count:
+            heapq.heappush(self.slowest_statements, (elapsed, statement))
+        elif elapsed > self.slowest_statements[0][0]:
+            heapq.heapreplace(self.slowest_statements, (elapsed, statement))
+
+    def merge(self, statistics):
+        self.calls += statistics.calls
+        self.statement_count += statistics.statement_count
+        self.total_time += statistics.total_time
+        for elapsed, statement in statistics.slowest_statements:
+            if len(self.slowest_statements) < self.slowest_count:
+                heapq.heappush(self.slowest_statements, (elapsed, statement))
+            elif elapsed > self.slowest_statements[0][0]:
+                heapq.heapreplace(self.slowest_statements, (elapsed, statement))
+
+    def slowest(self):
+        return sorted(self.slowest_statements, reverse=True)
+
+    def __str__(self):
+        return f'{self.name}: {self.calls} calls, {self.statement_count} statements, {self.total_time * 1000:.1f} ms'
+
+
+class QueryProfiler(object):
+    # Times every statement the engine runs and files it under each named operation in progress on the thread that ran
+    # it, so that operations on other threads, like the apps' planning threads, do not count each other's statements.
+    def __init__(self, engine, logger=None, slowest_count=SLOWEST_STATEMENT_COUNT):
+        self.engine = engine
+        self.logger = logger
+        self.slowest_count = slowest_count
+        self.operations = {}
+        self.operations_lock = threading.Lock()
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.remove(self.engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    @property
+    def running(self):
+        if not hasattr(self.local, 'running'):
+            self.local.running = []
+        return self.local.running
+
+    def before_cursor_execute(self, connection, *_):
+        connection.info.setdefault('statement_start_times', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, connection, _, statement, *__):
+        elapsed = time.perf_counter() - connection.info['statement_start_times'].pop()
+        for statistics in self.running:
+            statistics.record(statement, elapsed)
+
+    @contextmanager
+    def operation(self, name):
+        # Yields the statistics for this call alone; they are added to the totals for the name when it finishes.
+        statistics = OperationStatistics(name, self.slowest_count)
+        statistics.calls = 1
+        self.running.append(statistics)
+        try:
+            yield statistics
+        finally:
+            self.running.remove(statistics)
+            with self.operations_lock:
+                self.operations.setdefault(name, OperationStatistics(name, self.slowest_count)).merge(statistics)
+            if self.logger is not None:
+                self.logger.info(f'QueryProfiler: {statistics}')
+
+    def reset(self):
+        with self.operations_lock:
+            self.operations = {}
+
+    def report(self):
+        lines = []
+        with self.operations_lock:
+            operations = list(self.operations.values())
+        for statistics in sorted(operations, key=lambda item: item.total_time, reverse=True):
+            lines.append(str(statistics))
+            for elapsed, statement in statistics.slowest():
+                lines.append(f'    {elapsed * 1000:8.1f} ms  {" ".join(statement.split())[:200]}')
+        return '\n'.join(lines)
+
+
+def profiled(method):
+    # Files the statements an app method runs under the method's name while its database is being profiled.
+    @functools.wraps(method)
+    def wrapper(app, *args, **kwargs):
+        database = app.session.info.get('database') if app.session is not None else None
+        with database.operation(method.__name__) if database is not None else nullcontext():
+            return method(app, *args, **kwargs)
+    return wrapper
+
+
+class UnitOfWork(object):
+    # Collects a session's adds and deletes and commits them once; batches opened inside a batch join it.
+    def __init__(self, session):
+        self.session = session
+        self.depth = 0
+        self.commits_requested = 0
+        self.commits = 0
+
+    @staticmethod
+    def of(session):
+        if 'unit_of_work' not in session.info:
+            session.info['unit_of_work'] = UnitOfWork(session)
+        return session.info['unit_of_work']
+
+    @property
+    def commits_saved(self):
+        return self.commits_requested - self.commits
+
+    @contextmanager
+    def batch(self):
+        commits_requested = self.commits_requested
+        self.depth += 1
+        try:
+            yield self
+            if self.depth == 1 and self.commits_requested > commits_requested:
+                self.session.commit()
+                self.commits += 1
+        except Exception:
+            if self.depth == 1:
+                self.session.rollback()
+            raise
+        finally:
+            self.depth -= 1
+
+    def add(self, data):
+        if type(data) is list:
+            self.session.add_all(data)
+        else:
+            self.session.add(data)
+        self.commit()
+
+    def delete(self, data):
+        if type(data) is list:
+            for item in data:
+                self.session.delete(item)
+        else:
+            self.session.delete(data)
+        self.commit()
+
+    def commit(self):
+        # Stands in for session.commit(); inside a batch the commit waits for the outermost batch to finish.
+        self.commits_requested += 1
+        if self.depth == 0:
+            self.session.commit()
+            self.commits += 1
+
+    def __str__(self):
+        return f'{self.commits} commits for {self.commits_requested} requested, {self.commits_saved} saved'
+
+
 class Database(object):
     @staticmethod
     def construct_mysql_url(authority, port, database, username, password):
@@ -121,9 +481,66 @@ class Database(object):
         self.engine = create_engine(url)
         self.Session = sessionmaker()
         self.Session.configure(bind=self.engine)
+        self.profiler = None
+        if os.environ.get('PROFILE_QUERIES'):
+            self.profile(logging.getLogger('database'))
 
     def ensure_tables_exist(self):
         Persisted.metadata.create_all(self.engine)
 
-    def create_session(self):
-        return self.Session()
+    def ensure_version_triggers_exist(self):
+        # Left to the database installer, since MySQL with binary logging only lets privileged accounts create
+        # triggers. Returns False when they could not be added, in which case table_fingerprint hashes the tables.
+        try:
+            self.add_version_triggers()
+        except SQLAlchemyError:
+            return False
+        return True
+
+    def add_version_triggers(self):
+        with self.engine.begin() as connection:
+            if connection.dialect.name == 'sqlite':
+                trigger_names = set(connection.execute(text(
+                    "SELECT name FROM sqlite_master WHERE type = 'trigger'")).scalars())
+            else:
+                trigger_names = set(connection.execute(text('SELECT trigger_name FROM information_schema.triggers '
+                                                            'WHERE trigger_schema = DATABASE()')).scalars())
+            for table_name in VERSIONED_TABLES:
+                for operation in ('INSERT', 'UPDATE', 'DELETE'):
+                    if f'{table_name}_{operation.lower()}_version' not in trigger_names:
+                        connection.execute(text(version_trigger_statement(connection.dialect.name, table_name,
+                                                                          operation)))
+            # The counters are only added once their triggers exist, so table_versions never vouches for a table
+            # whose writes go uncounted. They start anywhere, so a database built again from scratch does not
+            # repeat the versions of the one it replaced.
+            known_names = set(connection.execute(select(TableVersion.table_name)).scalars())
+            missing_names = [name for name in TABLE_VERSION_NAMES if name not in known_names]
+            if missing_names:
+                connection.execute(TableVersion.__table__.insert(), [
+                    {'table_name': name, 'version': random.randrange(1 << 30)} for name in missing_names])
+
+    def ensure_indexes_exist(self):
+        # create_all skips tables that already exist, so their indexes have to be added one at a time.
+        missing_indexes = []
+        for table in Persisted.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    index.create(self.engine, checkfirst=True)
+                except SQLAlchemyError:
+                    missing_indexes.append(index.name)
+        return missing_indexes
+
+    def profile(self, logger=None):
+        if self.profiler is None:
+            self.profiler = QueryProfiler(self.engine, logger)
+        return self.profiler
+
+    def operation(self, name):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.operation(name)
+
+    def create_session(self, **options):
+        session = self.Session(**options)
+        session.info['database'] = self
+        return session
@@ -1,8 +1,12 @@
-from datetime import date
+from datetime import date, timedelta
 from sys import stderr
 import json
+from sqlalchemy import func, inspect, bindparam, text, Date
 from sqlalchemy.exc import SQLAlchemyError
-from database import Database, City, Airport, Venue, Condition, Review
+from sqlalchemy.schema import AddConstraint, CreateColumn
+from database import Database, City, Airport, Venue, Condition, Review, Itinerary
+
+ITINERARY_NAME_COLUMNS = ['airport', 'airport_left_from', 'city', 'next_itinerary']
 
 
 def add_starter_data(session):
@@ -215,7 +219,7 @@ def add_starter_data(session):
     session.add(a1)
     b1 = City(city_name='Bauchi', encompassing_geographic_entity='Nigeria', latitude=10.3158, longitude=9.8442,
               venues=[fort_venue_2, maple_venue_2])
-    b2 = City(city_name='Bauchi', encompassing_geographic_entity='Nigeria', latitude=10.3158, longitude=9.8442,
+    b2 = City(city_name='Azare', encompassing_geographic_entity='Nigeria', latitude=11.6765, longitude=10.1948,
               venues=[blondo_venue, fort_venue_1])
     b3 = City(city_name='Wukari', encompassing_geographic_entity='Nigeria', latitude=7.8704, longitude=9.78,
               venues=[fort_venue_2, maple_venue_2])
@@ -864,6 +868,68 @@ def add_starter_data(session):
     session.add(a1)
 
 
+def remove_duplicate_forecasts(session):
+    # Keeps the newest forecast for each place and day so the unique indexes can be added.
+    for place_column in (Condition.city_id, Condition.airport_id):
+        duplicates = session.query(place_column, Condition.date, func.max(Condition.condition_id)).filter(
+            place_column.isnot(None), Condition.date.isnot(None)).group_by(place_column, Condition.date).having(
+            func.count(Condition.condition_id) > 1).all()
+        for place_id, forecast_date, newest_condition_id in duplicates:
+            session.query(Condition).filter(place_column == place_id, Condition.date == forecast_date,
+                                            Condition.condition_id != newest_condition_id).delete(
+                synchronize_session=False)
+    session.commit()
+
+
+def migrate_itinerary_places(database):
+    # Itineraries used to store airport and city names; this swaps each name for a key to the row it named. It
+    # raises ValueError, changing nothing, when a name matches no airport or city, so that no itinerary loses its place.
+    if 'city' not in {column['name'] for column in inspect(database.engine).get_columns('itineraries')}:
+        return False
+    table = Itinerary.__table__
+    with database.engine.begin() as connection:
+        airport_ids = dict(connection.execute(text('SELECT name, airport_id FROM airports')).all())
+        city_ids = dict(connection.execute(text('SELECT city_name, city_id FROM cities')).all())
+        rows = connection.execute(text('SELECT itinerary_id, airport, airport_left_from, city, next_itinerary, date, '
+                                       'itinerary_type FROM itineraries').columns(date=Date)).all()
+        unknown_names = sorted({name for row in rows for name in (row.airport, row.airport_left_from)
+                                if name is not None and name not in airport_ids} |
+                               {row.city for row in rows if row.city is not None and row.city not in city_ids})
+        if unknown_names:
+            raise ValueError(f'No airport or city is named {", ".join(unknown_names)}')
+        for column_name in ['airport_id', 'airport_left_from_id', 'city_id', 'next_itinerary_id']:
+            column = CreateColumn(table.c[column_name]).compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE itineraries ADD COLUMN {column}'))
+        # next_itinerary named the city visited the following day, preferably on the same kind of itinerary.
+        itineraries_by_day = {}
+        for row in sorted(rows, key=lambda row: row.itinerary_type):
+            itineraries_by_day[(row.city, row.date, row.itinerary_type)] = row.itinerary_id
+            itineraries_by_day.setdefault((row.city, row.date, None), row.itinerary_id)
+        updates = []
+        for row in rows:
+            next_day = row.date + timedelta(days=1) if row.date is not None else None
+            updates.append({
+                'key': row.itinerary_id,
+                'airport_id': airport_ids.get(row.airport),
+                'airport_left_from_id': airport_ids.get(row.airport_left_from),
+                'city_id': city_ids.get(row.city),
+                'next_itinerary_id': itineraries_by_day.get((row.next_itinerary, next_day, row.itinerary_type),
+                                                            itineraries_by_day.get((row.next_itinerary, next_day,
+                                                                                    None)))
+            })
+        if updates:
+            connection.execute(table.update().where(table.c.itinerary_id == bindparam('key')).values(
+                airport_id=bindparam('airport_id'), airport_left_from_id=bindparam('airport_left_from_id'),
+                city_id=bindparam('city_id'), next_itinerary_id=bindparam('next_itinerary_id')), updates)
+        for column_name in ITINERARY_NAME_COLUMNS:
+            connection.execute(text(f'ALTER TABLE itineraries DROP COLUMN {column_name}'))
+        # SQLite cannot add constraints to an existing table; it does not enforce them by default either.
+        if connection.dialect.name != 'sqlite':
+            for constraint in table.foreign_key_constraints:
+                connection.execute(AddConstraint(constraint))
+    return True
+
+
 def main():
     try:
         database_credentials = open('database_credentials.json')
@@ -873,10 +939,28 @@ def main():
                                            data['password'])
         database = Database(url)
         database.ensure_tables_exist()
+        if not database.ensure_version_triggers_exist():
+            print('Triggers counting table writes could not be added, so the travel planner will hash the tables to '
+                  'see whether they changed. Rerun as a user allowed to create triggers to add them.', file=stderr)
+        try:
+            if migrate_itinerary_places(database):
+                print('Itineraries now refer to their airports and cities by key.')
+        except ValueError as exception:
+            print(f'Itineraries were left unchanged: {exception}. Correct or remove the itineraries that use those '
+                  'names and rerun.', file=stderr)
+            exit(1)
         session = database.create_session()
-        add_starter_data(session)
-        session.commit()
-        print('Tables and records created.')
+        if session.query(Airport).count() == 0:
+            add_starter_data(session)
+            session.commit()
+            print('Tables and records created.')
+        else:
+            remove_duplicate_forecasts(session)
+            print('Tables checked, existing records kept.')
+        missing_indexes = database.ensure_indexes_exist()
+        for index_name in missing_indexes:
+            print(f'Index {index_name} could not be added, remove the duplicate rows it covers and rerun.',
+                  file=stderr)
     except SQLAlchemyError as exception:
         print('Database setup failed!', file=stderr)
         print(f'Cause: {exception}', file=stderr)
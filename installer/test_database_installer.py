@@ -0,0 +1,82 @@
+import unittest
+from datetime import date, timedelta
+from sqlalchemy import inspect, text
+from database_installer import *
+from database import Persisted, ItineraryVenue
+
+
+def create_legacy_database():
+    # The layout from before itineraries referred to places by key, when they stored names instead.
+    database = Database(Database.construct_in_memory_url())
+    Persisted.metadata.create_all(database.engine, tables=[
+        table for table in Persisted.metadata.sorted_tables
+        if table not in (Itinerary.__table__, ItineraryVenue.__table__)])
+    with database.engine.begin() as connection:
+        connection.execute(text('CREATE TABLE itineraries (itinerary_id INTEGER PRIMARY KEY, airport VARCHAR(256), '
+                                'airport_left_from VARCHAR(256), city VARCHAR(256), date DATE, '
+                                'itinerary_type VARCHAR(256), next_itinerary VARCHAR(256), selected BOOLEAN)'))
+    return database
+
+
+class TestDatabaseInstaller(unittest.TestCase):
+    def test_migrate_itinerary_places(self):
+        database = create_legacy_database()
+        session = database.create_session()
+        for name, latitude in [('Lincoln', 40.85), ('Denver', 39.86)]:
+            city = City(city_name=name, latitude=latitude, longitude=-100,
+                        encompassing_geographic_entity='United States')
+            session.add(Airport(name=f'{name} Airport', latitude=latitude, longitude=-100, cities=[city]))
+        session.commit()
+        today = date.today()
+        tomorrow = today + timedelta(days=1)
+        legacy_rows = [
+            (1, 'Lincoln Airport', 'Lincoln Airport', 'Lincoln', today, 'Entertain', 'Denver'),
+            (2, 'Lincoln Airport', 'Lincoln Airport', 'Lincoln', today, 'Close', 'Denver'),
+            (3, 'Denver Airport', 'Lincoln Airport', 'Denver', tomorrow, 'Close', None),
+            (4, 'Denver Airport', 'Denver Airport', 'Denver', tomorrow, 'Entertain', 'Nowhere'),
+            (5, 'Unknown Airport', None, 'Nowhere', tomorrow, 'Past', None),
+        ]
+        with database.engine.begin() as connection:
+            for row in legacy_rows:
+                connection.execute(text(
+                    'INSERT INTO itineraries (itinerary_id, airport, airport_left_from, city, date, itinerary_type, '
+                    'next_itinerary) VALUES (:id, :airport, :left_from, :city, :date, :type, :next)'),
+                    dict(zip(['id', 'airport', 'left_from', 'city', 'date', 'type', 'next'], row)))
+
+        # A name that matches no place stops the migration before it changes anything.
+        with self.assertRaises(ValueError):
+            migrate_itinerary_places(database)
+        columns = {column['name'] for column in inspect(database.engine).get_columns('itineraries')}
+        self.assertTrue(set(ITINERARY_NAME_COLUMNS) <= columns)
+        self.assertNotIn('city_id', columns)
+        with database.engine.begin() as connection:
+            self.assertEqual(connection.execute(text('SELECT COUNT(*) FROM itineraries')).scalar(), 5)
+            connection.execute(text('DELETE FROM itineraries WHERE itinerary_id = 5'))
+
+        self.assertTrue(migrate_itinerary_places(database))
+        columns = {column['name'] for column in inspect(database.engine).get_columns('itineraries')}
+        self.assertTrue(columns.isdisjoint(ITINERARY_NAME_COLUMNS))
+        self.assertTrue({'airport_id', 'airport_left_from_id', 'city_id', 'next_itinerary_id'} <= columns)
+        session = database.create_session()
+        lincoln = session.query(Airport).filter(Airport.name == 'Lincoln Airport').one()
+        denver = session.query(Airport).filter(Airport.name == 'Denver Airport').one()
+        itineraries = {itinerary.itinerary_id: itinerary
+                       for itinerary in session.query(Itinerary).order_by(Itinerary.itinerary_id)}
+        self.assertEqual([(itinerary.airport_id, itinerary.airport_left_from_id, itinerary.city_id)
+                          for itinerary in itineraries.values()],
+                         [(lincoln.airport_id, lincoln.airport_id, lincoln.cities[0].city_id),
+                          (lincoln.airport_id, lincoln.airport_id, lincoln.cities[0].city_id),
+                          (denver.airport_id, lincoln.airport_id, denver.cities[0].city_id),
+                          (denver.airport_id, denver.airport_id, denver.cities[0].city_id)])
+        self.assertEqual(itineraries[3].airport.name, 'Denver Airport')
+        # Each itinerary leads to the next day's itinerary of its own kind, when there is one.
+        self.assertIs(itineraries[1].next_itinerary, itineraries[4])
+        self.assertIs(itineraries[2].next_itinerary, itineraries[3])
+        self.assertIsNone(itineraries[3].next_itinerary)
+        self.assertIsNone(itineraries[4].next_itinerary)
+        self.assertEqual(itineraries[1].date, today)
+        self.assertFalse(migrate_itinerary_places(database))
+
+
+if __name__ == '__main__':
+    unittest.main()
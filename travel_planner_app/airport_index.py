@@ -0,0 +1,122 @@
+import math
+from sqlalchemy import event
+from sqlalchemy.orm import selectinload
+from database import Airport, City, Venue
+from distance import EARTH_RADIUS, distances_to
+
+CELL_SIZE = 5
+
+# Every relationship the planner walks while scoring airports, so each costs one SELECT per run instead of one per row.
+AIRPORT_GRAPH = (
+    selectinload(Airport.conditions),
+    selectinload(Airport.cities).selectinload(City.airports),
+    selectinload(Airport.cities).selectinload(City.conditions),
+    selectinload(Airport.cities).selectinload(City.venues).selectinload(Venue.condition),
+)
+
+
+class AirportIndex(object):
+    # Buckets airports into a latitude/longitude grid so range queries only look at nearby cells.
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.rows = int(math.ceil(180 / cell_size))
+        self.columns = int(math.ceil(360 / cell_size))
+        self.cells = {}
+        self.locations = {}
+
+    @staticmethod
+    def build(session, cell_size=CELL_SIZE):
+        return AirportIndex.of(session.query(Airport).options(*AIRPORT_GRAPH), cell_size)
+
+    @staticmethod
+    def of(airports, cell_size=CELL_SIZE):
+        index = AirportIndex(cell_size)
+        for airport in airports:
+            index.add(airport)
+        return index
+
+    def __len__(self):
+        return len(self.locations)
+
+    def cell(self, latitude, longitude):
+        row = min(int((latitude + 90) // self.cell_size), self.rows - 1)
+        column = int((longitude + 180) // self.cell_size) % self.columns
+        return row, column
+
+    def cell_of(self, airport):
+        if airport.latitude is None or airport.longitude is None:
+            return None
+        return self.cell(float(airport.latitude), float(airport.longitude))
+
+    def add(self, airport):
+        key = self.cell_of(airport)
+        if key is None or airport in self.locations:
+            return
+        self.cells.setdefault(key, []).append(airport)
+        self.locations[airport] = key
+
+    def remove(self, airport):
+        key = self.locations.pop(airport, None)
+        if key is not None:
+            self.cells[key].remove(airport)
+
+    def move(self, airport):
+        # Files an airport under the cell of its current coordinates, if that is not where it already is.
+        if self.locations.get(airport) != self.cell_of(airport):
+            self.remove(airport)
+            self.add(airport)
+
+    def watch(self, session):
+        # Keeps the index fresh as the planner's own session inserts, moves or deletes airports.
+        event.listen(session, 'after_flush', self.on_flush)
+
+    def on_flush(self, session, _):
+        for item in session.new:
+            if isinstance(item, Airport):
+                self.add(item)
+        for item in session.dirty:
+            if isinstance(item, Airport):
+                self.move(item)
+        for item in session.deleted:
+            if isinstance(item, Airport):
+                self.remove(item)
+
+    def refresh(self, session):
+        # Reloads the airport graph, picking up rows the other apps wrote, moved or deleted since the last planning run.
+        airports = session.query(Airport).options(*AIRPORT_GRAPH).populate_existing().all()
+        loaded = set(airports)
+        for airport in [airport for airport in self.locations if airport not in loaded]:
+            self.remove(airport)
+        for airport in airports:
+            self.move(airport)
+
+    def candidate_cells(self, latitude, longitude, radius):
+        angular_radius = radius / EARTH_RADIUS
+        latitude_span = math.degrees(angular_radius)
+        min_latitude = latitude - latitude_span
+        max_latitude = latitude + latitude_span
+        first_row, _ = self.cell(max(min_latitude, -90), 0)
+        last_row, _ = self.cell(min(max_latitude, 90), 0)
+        rows = range(first_row, last_row + 1)
+        columns = range(self.columns)
+        if min_latitude > -90 and max_latitude < 90:
+            ratio = math.sin(angular_radius) / math.cos(math.radians(latitude))
+            if ratio < 1:
+                longitude_span = math.degrees(math.asin(ratio))
+                _, first_column = self.cell(0, longitude - longitude_span)
+                _, last_column = self.cell(0, longitude + longitude_span)
+                width = (last_column - first_column) % self.columns + 1
+                columns = [(first_column + i) % self.columns for i in range(width)]
+        for row in rows:
+            for column in columns:
+                if (row, column) in self.cells:
+                    yield self.cells[row, column]
+
+    def airports_within(self, latitude, longitude, radius):
+        candidates = []
+        for airports in self.candidate_cells(float(latitude), float(longitude), radius):
+            candidates.extend(airports)
+        if not candidates:
+            return []
+        distances = distances_to(candidates, latitude, longitude)
+        return [airport for airport, distance in zip(candidates, distances) if distance <= radius]
@@ -0,0 +1,48 @@
+from datetime import timedelta
+from sqlalchemy import event
+from database import Condition
+
+
+def is_flying_weather(forecast):
+    # Figure out severe weather
+    return forecast.max_temperature < 45 and forecast.visibility > 5
+
+
+class AirportWeather(object):
+    # Whether each airport's forecast allows flying on each date, by airport_id. An airport's flags are worked out
+    # from all of its forecasts the first time it is asked about and forgotten when its forecasts are written.
+    def __init__(self):
+        self.airports = {}
+
+    @staticmethod
+    def of(session):
+        if 'airport_weather' not in session.info:
+            session.info['airport_weather'] = AirportWeather()
+            event.listen(session, 'after_flush', session.info['airport_weather'].on_flush)
+        return session.info['airport_weather']
+
+    def on_flush(self, session, _):
+        for item in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(item, Condition) and item.airport_id is not None:
+                self.invalidate(item.airport_id)
+
+    def reset(self):
+        self.airports = {}
+
+    def invalidate(self, airport_id):
+        self.airports.pop(airport_id, None)
+
+    def flags(self, airport):
+        # None for an airport without forecasts, which is never held back by the weather.
+        if airport.airport_id not in self.airports:
+            forecasts = airport.conditions
+            flags = {} if forecasts else None
+            for forecast in forecasts:
+                flags[forecast.date] = flags.get(forecast.date, False) or is_flying_weather(forecast)
+            self.airports[airport.airport_id] = flags
+        return self.airports[airport.airport_id]
+
+    def is_ok(self, airport, current_date):
+        # The planner leaves on the day after current_date.
+        flags = self.flags(airport)
+        return flags is None or flags.get(current_date + timedelta(days=1), False)
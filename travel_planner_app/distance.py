@@ -0,0 +1,33 @@
+import numpy
+
+EARTH_RADIUS = 6371
+
+
+def haversine_distances(latitudes, longitudes, target_latitudes, target_longitudes):
+    # Inputs broadcast against each other, so one call can measure many places against one or many targets.
+    latitudes = numpy.radians(numpy.asarray(latitudes, dtype=float))
+    longitudes = numpy.radians(numpy.asarray(longitudes, dtype=float))
+    target_latitudes = numpy.radians(numpy.asarray(target_latitudes, dtype=float))
+    target_longitudes = numpy.radians(numpy.asarray(target_longitudes, dtype=float))
+    half_chord = numpy.sin((target_latitudes - latitudes) / 2) ** 2 + \
+        numpy.cos(latitudes) * numpy.cos(target_latitudes) * numpy.sin((target_longitudes - longitudes) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(half_chord, 0, 1)))
+
+
+def coordinates(places):
+    latitudes = numpy.fromiter((float(place.latitude) for place in places), dtype=float, count=len(places))
+    longitudes = numpy.fromiter((float(place.longitude) for place in places), dtype=float, count=len(places))
+    return latitudes, longitudes
+
+
+def distances_to(places, target_latitude, target_longitude):
+    latitudes, longitudes = coordinates(places)
+    return haversine_distances(latitudes, longitudes, target_latitude, target_longitude)
+
+
+def distance_matrix(places, targets):
+    # Rows follow places and columns follow targets.
+    latitudes, longitudes = coordinates(places)
+    target_latitudes, target_longitudes = coordinates(targets)
+    return haversine_distances(latitudes[:, numpy.newaxis], longitudes[:, numpy.newaxis],
+                               target_latitudes[numpy.newaxis, :], target_longitudes[numpy.newaxis, :])
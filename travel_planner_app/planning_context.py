@@ -0,0 +1,110 @@
+from sqlalchemy import event, inspect
+from database import City, Condition, Venue, table_fingerprint
+
+# Venue requirements are counted with the city forecasts, as neither belongs to an airport.
+SCORE_TABLE_VERSIONS = ['city_conditions', 'venues', 'city_venues', 'venue_conditions']
+
+
+def score_fingerprint(session):
+    # Changes with every write to a city forecast, a venue, a venue requirement or a city's venues, whoever makes it.
+    # Airport forecasts are left out, since no city score depends on them.
+    return table_fingerprint(session, SCORE_TABLE_VERSIONS)
+
+
+class PlanningContext(object):
+    # Remembers city scores and forecasts by city_id and then date, forgetting a city when its forecasts or venues are
+    # written. Scores are kept from one planning run to the next for as long as score_fingerprint is unchanged, while
+    # forecasts are indexed afresh each run from the objects the run loaded.
+    def __init__(self):
+        self.scores = {}
+        self.forecasts = {}
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def of(session):
+        if 'planning_context' not in session.info:
+            session.info['planning_context'] = PlanningContext()
+            event.listen(session, 'after_flush', session.info['planning_context'].on_flush)
+        return session.info['planning_context']
+
+    def on_flush(self, session, _):
+        # A city's score also counts its open venues, so a change to a venue, to its requirement or to which cities
+        # it is in forgets the scores of the cities it is in or has just left.
+        venues = []
+        city_ids = set()
+        for item in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(item, Condition) and item.city_id is not None:
+                self.invalidate(item.city_id)
+            elif isinstance(item, Condition) and item.airport_id is None:
+                venues.extend(item.venue)
+            elif isinstance(item, Venue):
+                venues.append(item)
+            elif isinstance(item, City):
+                city_ids.add(item.city_id)
+        for venue in venues:
+            city_ids.update(city.city_id for city in venue.cities)
+            city_ids.update(city.city_id for city in inspect(venue).attrs.cities.history.deleted)
+        self.invalidate_scores(city_ids)
+
+    def reset(self):
+        self.scores = {}
+        self.forecasts = {}
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+
+    def start_run(self, session, current_date):
+        # Keeps the scores still current when nothing they depend on changed since the last run, and starts counting
+        # hits afresh.
+        fingerprint = score_fingerprint(session)
+        if fingerprint != self.fingerprint:
+            self.reset()
+            self.fingerprint = fingerprint
+        for city_scores in self.scores.values():
+            for score_date in [score_date for score_date in city_scores if score_date < current_date]:
+                del city_scores[score_date]
+        self.forecasts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, city_id):
+        self.scores.pop(city_id, None)
+        self.forecasts.pop(city_id, None)
+
+    def invalidate_scores(self, city_ids):
+        for city_id in city_ids:
+            self.scores.pop(city_id, None)
+
+    def known_score(self, city_id, current_date):
+        # Looks a score up without counting it as a hit or a miss.
+        return self.scores.get(city_id, {}).get(current_date)
+
+    def score(self, city_id, current_date):
+        score = self.known_score(city_id, current_date)
+        if score is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return score
+
+    def remember_score(self, city_id, current_date, score):
+        self.scores.setdefault(city_id, {})[current_date] = score
+
+    def forecast(self, city, current_date):
+        # Indexes all of a city's forecasts by date the first time any of them is asked for.
+        if city.city_id in self.forecasts:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.forecasts[city.city_id] = {forecast.date: forecast for forecast in city.conditions}
+        return self.forecasts[city.city_id].get(current_date)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def __str__(self):
+        return f'{self.hits} hits, {self.misses} misses, {self.hit_rate:.0%} hit rate'
@@ -1,17 +1,183 @@
 import base64
+import gzip
+import http.client
 import json
+import shelve
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import LifoQueue, Empty
 
-from kivy.network.urlrequest import UrlRequest
-from urllib.parse import quote
+from urllib.parse import quote, urlsplit
+
+FORECAST_TIME_TO_LIVE = 10 * 60
+FORECAST_CACHE_SIZE = 256
+FORECAST_CACHE_PRECISION = 2
+REQUEST_TIMEOUT = 30
+MAX_CONCURRENT_REQUESTS = 8
+CONNECTION_POOL_SIZE = MAX_CONCURRENT_REQUESTS
+
+
+class ForecastCache:
+    # Keeps responses for rounded coordinates on disk, evicting the least recently used once full.
+    def __init__(self, path, time_to_live=FORECAST_TIME_TO_LIVE, maximum_entries=FORECAST_CACHE_SIZE,
+                 precision=FORECAST_CACHE_PRECISION):
+        self.time_to_live = time_to_live
+        self.maximum_entries = maximum_entries
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.store = shelve.open(path)
+        self.entries = OrderedDict(sorted(((key, self.store[key]) for key in self.store.keys()),
+                                          key=lambda item: item[1][0]))
+
+    def construct_key(self, resource, latitude, longitude):
+        return f'{resource}:{round(float(latitude), self.precision)}:{round(float(longitude), self.precision)}'
+
+    def get(self, resource, latitude, longitude):
+        with self.lock:
+            return self._get(resource, latitude, longitude)
+
+    def _get(self, resource, latitude, longitude):
+        key = self.construct_key(resource, latitude, longitude)
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[0] > self.time_to_live:
+            self.remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, resource, latitude, longitude, response):
+        with self.lock:
+            self._put(resource, latitude, longitude, response)
+
+    def _put(self, resource, latitude, longitude, response):
+        key = self.construct_key(resource, latitude, longitude)
+        self.entries[key] = (time.time(), response)
+        self.entries.move_to_end(key)
+        self.store[key] = self.entries[key]
+        while len(self.entries) > self.maximum_entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+        if key in self.store:
+            del self.store[key]
+
+    def storing(self, resource, latitude, longitude, on_success):
+        def on_response(request, response):
+            self.put(resource, latitude, longitude, response)
+            on_success(request, response)
+        return on_response
+
+    def close(self):
+        self.store.close()
+
+
+class ConnectionPool:
+    # Keeps keep-alive connections to one authority so requests skip the TCP and TLS handshakes.
+    shared_pools = {}
+    shared_pools_lock = threading.Lock()
+
+    def __init__(self, authority, port, size=CONNECTION_POOL_SIZE, secure=True):
+        self.authority = authority
+        self.port = port
+        self.size = size
+        self.secure = secure
+        self.idle_connections = LifoQueue()
+        self.available = threading.Semaphore(size)
+        self.connections_opened = 0
+
+    @staticmethod
+    def shared(authority, port, size=CONNECTION_POOL_SIZE, secure=True):
+        with ConnectionPool.shared_pools_lock:
+            key = (authority, port, secure)
+            if key not in ConnectionPool.shared_pools:
+                ConnectionPool.shared_pools[key] = ConnectionPool(authority, port, size, secure)
+            else:
+                ConnectionPool.shared_pools[key].grow(size)
+            return ConnectionPool.shared_pools[key]
+
+    def grow(self, size):
+        # Lets the pool run as many requests at once as the largest size asked of it. It never shrinks, since
+        # requests in flight may hold the connections a smaller size would give up.
+        for _ in range(size - self.size):
+            self.available.release()
+        self.size = max(self.size, size)
+
+    def open_connection(self, timeout):
+        self.connections_opened += 1
+        if self.secure:
+            return http.client.HTTPSConnection(self.authority, self.port, timeout=timeout)
+        return http.client.HTTPConnection(self.authority, self.port, timeout=timeout)
+
+    def request(self, method, path, body, headers, timeout=REQUEST_TIMEOUT):
+        # Waiting for a free connection counts against the timeout too, so a busy pool cannot hang its callers.
+        if not self.available.acquire(timeout=timeout):
+            raise TimeoutError(f'No connection to {self.authority} came free within {timeout} s')
+        try:
+            try:
+                connection = self.idle_connections.get_nowait()
+                reused = True
+            except Empty:
+                connection = self.open_connection(timeout)
+                reused = False
+            try:
+                status, data, will_close = self.exchange(connection, method, path, body, headers, timeout)
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+                # The server may have dropped an idle connection, so try once more on a fresh one.
+                connection = self.open_connection(timeout)
+                status, data, will_close = self.exchange(connection, method, path, body, headers, timeout)
+            if will_close:
+                connection.close()
+            else:
+                self.idle_connections.put(connection)
+            return status, data
+        finally:
+            self.available.release()
+
+    @staticmethod
+    def exchange(connection, method, path, body, headers, timeout):
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        connection.request(method, path, body=body, headers=headers)
+        reply = connection.getresponse()
+        data = reply.read()
+        if reply.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        return reply.status, data, reply.will_close
+
+    def close(self):
+        while True:
+            try:
+                self.idle_connections.get_nowait().close()
+            except Empty:
+                return
 
 
 class RESTConnection:
-    def __init__(self, authority, port, root_path, username=None, password=None):
+    def __init__(self, authority, port, root_path, username=None, password=None, cache=None,
+                 max_workers=MAX_CONCURRENT_REQUESTS, pool_size=CONNECTION_POOL_SIZE, secure=True):
         self.authority = authority
         self.port = port
         self.root_path = root_path
+        self.cache = cache
+        self.scheme = 'https' if secure else 'http'
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pool = ConnectionPool.shared(authority, port, pool_size, secure)
         self.headers = {
             'Content-type': 'application/json',
+            'Accept-Encoding': 'gzip',
         }
         if username is not None and password is not None:
             credentials = base64.standard_b64encode(f'{username}:{password}'.encode('UTF8')).decode('UTF8')
@@ -20,14 +186,56 @@ class RESTConnection:
     def construct_url(self, resource, get_parameters=None):
         parameter_string = '&'.join(f'{quote(str(key))}={quote(str(value))}' for key, value in get_parameters.items()) \
             if get_parameters is not None else ''
-        return f'https://{self.authority}:{self.port}{self.root_path}/{resource}?{parameter_string}'
+        return f'{self.scheme}://{self.authority}:{self.port}{self.root_path}/{resource}?{parameter_string}'
 
     def send_request_by_url(self, url, post_parameters, on_success, on_failure, on_error):
-        response = UrlRequest(url, req_headers=self.headers,
-                              req_body=json.dumps(post_parameters) if post_parameters is not None else None,
-                              on_success=on_success, on_failure=on_failure, on_error=on_error)
-        response.wait()
+        try:
+            status, data = self.fetch(url, post_parameters)
+        except (http.client.HTTPException, OSError) as error:
+            on_error(None, error)
+            return
+        try:
+            response = json.loads(data)
+        except ValueError:
+            response = data.decode('UTF8', 'replace')
+        if status < 400:
+            on_success(None, response)
+        else:
+            on_failure(None, response)
+
+    def fetch(self, url, post_parameters, timeout=REQUEST_TIMEOUT):
+        parts = urlsplit(url)
+        path = f'{parts.path}?{parts.query}' if parts.query else parts.path
+        body = json.dumps(post_parameters).encode('UTF8') if post_parameters is not None else None
+        return self.pool.request('POST' if body is not None else 'GET', path, body, self.headers, timeout)
+
+    def request_json(self, resource, get_parameters, post_parameters=None, timeout=REQUEST_TIMEOUT):
+        # Blocking and safe to call from worker threads.
+        cacheable = self.cache is not None and get_parameters is not None and 'lat' in get_parameters \
+            and 'lon' in get_parameters
+        if cacheable:
+            response = self.cache.get(resource, get_parameters['lat'], get_parameters['lon'])
+            if response is not None:
+                return response
+        status, data = self.fetch(self.construct_url(resource, get_parameters), post_parameters, timeout)
+        if status >= 400:
+            raise ConnectionError(f'{resource} request failed with status {status}')
+        response = json.loads(data)
+        if cacheable:
+            self.cache.put(resource, get_parameters['lat'], get_parameters['lon'], response)
+        return response
+
+    def send_request_async(self, resource, get_parameters, post_parameters=None, timeout=REQUEST_TIMEOUT):
+        # Returns a future holding the parsed response, so many requests can be in flight and awaited together.
+        return self.executor.submit(self.request_json, resource, get_parameters, post_parameters, timeout)
 
     def send_request(self, resource, get_parameters, post_parameters, on_success, on_failure, on_error):
+        if self.cache is not None and get_parameters is not None and 'lat' in get_parameters \
+                and 'lon' in get_parameters:
+            response = self.cache.get(resource, get_parameters['lat'], get_parameters['lon'])
+            if response is not None:
+                on_success(None, response)
+                return
+            on_success = self.cache.storing(resource, get_parameters['lat'], get_parameters['lon'], on_success)
         url = self.construct_url(resource, get_parameters)
         self.send_request_by_url(url, post_parameters, on_success, on_failure, on_error)
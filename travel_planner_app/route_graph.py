@@ -0,0 +1,127 @@
+import heapq
+import numpy
+from sqlalchemy import or_
+from database import Airport, AirportCity, AirportRoute, MAX_FLIGHT_DISTANCE
+from distance import haversine_distances
+
+
+def build_airport_routes(session):
+    # Fills the routes table for databases that were installed before it existed.
+    airports = session.query(Airport.airport_id, Airport.latitude, Airport.longitude).filter(
+        Airport.latitude.isnot(None), Airport.longitude.isnot(None)).all()
+    airport_ids = [airport[0] for airport in airports]
+    latitudes = numpy.array([airport[1] for airport in airports], dtype=float)
+    longitudes = numpy.array([airport[2] for airport in airports], dtype=float)
+    routes = []
+    for i in range(len(airport_ids)):
+        distances = haversine_distances(latitudes[i], longitudes[i], latitudes, longitudes)
+        for j in numpy.nonzero(distances <= MAX_FLIGHT_DISTANCE)[0]:
+            if j != i:
+                routes.append({'from_airport_id': airport_ids[i], 'to_airport_id': airport_ids[j],
+                               'distance': float(distances[j])})
+    if routes:
+        session.execute(AirportRoute.__table__.insert(), routes)
+        session.commit()
+
+
+class RouteGraph(object):
+    # Adjacency lists over the airport_routes table, searched with A* using the great-circle distance as estimate.
+    def __init__(self):
+        self.routes = {}
+        self.locations = {}
+        self.serviced_airport_ids = set()
+        self.max_airport_id = 0
+
+    @staticmethod
+    def load(session):
+        if session.query(AirportRoute).first() is None:
+            build_airport_routes(session)
+        graph = RouteGraph()
+        graph.refresh(session)
+        return graph
+
+    def refresh(self, session):
+        # Adds the airports inserted since the last refresh, and starts over when any were deleted.
+        airport_ids = {row[0] for row in session.query(Airport.airport_id)}
+        if not airport_ids.issuperset(self.locations):
+            self.routes = {}
+            self.locations = {}
+            self.max_airport_id = 0
+        new_airports = session.query(Airport.airport_id, Airport.latitude, Airport.longitude).filter(
+            Airport.airport_id > self.max_airport_id, Airport.latitude.isnot(None),
+            Airport.longitude.isnot(None)).all()
+        if new_airports:
+            for airport_id, latitude, longitude in new_airports:
+                self.locations[airport_id] = (float(latitude), float(longitude))
+                self.routes.setdefault(airport_id, [])
+            routes = session.query(AirportRoute.from_airport_id, AirportRoute.to_airport_id,
+                                   AirportRoute.distance).filter(
+                or_(AirportRoute.from_airport_id > self.max_airport_id,
+                    AirportRoute.to_airport_id > self.max_airport_id))
+            for from_airport_id, to_airport_id, distance in routes:
+                # Without enforced foreign keys, a deleted airport's routes can outlive it.
+                if from_airport_id in airport_ids and to_airport_id in airport_ids:
+                    self.routes.setdefault(from_airport_id, []).append((to_airport_id, distance))
+            self.max_airport_id = max(airport[0] for airport in new_airports)
+        self.serviced_airport_ids = {row[0] for row in session.query(AirportCity.airport_id).distinct()}
+
+    def nearest_airport(self, latitude, longitude):
+        airport_ids = [airport_id for airport_id in self.serviced_airport_ids if airport_id in self.locations]
+        if not airport_ids:
+            return None
+        latitudes = numpy.array([self.locations[airport_id][0] for airport_id in airport_ids])
+        longitudes = numpy.array([self.locations[airport_id][1] for airport_id in airport_ids])
+        return airport_ids[int(numpy.argmin(haversine_distances(latitudes, longitudes, latitude, longitude)))]
+
+    def estimates_to(self, airport_id):
+        airport_ids = list(self.locations)
+        latitudes = numpy.array([self.locations[key][0] for key in airport_ids])
+        longitudes = numpy.array([self.locations[key][1] for key in airport_ids])
+        latitude, longitude = self.locations[airport_id]
+        return dict(zip(airport_ids, haversine_distances(latitudes, longitudes, latitude, longitude)))
+
+    def shortest_route(self, start_airport_id, goal_airport_id):
+        # Returns the airport ids flown to after the start, ending with the goal, or None when unreachable.
+        if start_airport_id == goal_airport_id:
+            return []
+        if start_airport_id not in self.locations or goal_airport_id not in self.locations:
+            return None
+        estimates = self.estimates_to(goal_airport_id)
+        distances = {start_airport_id: 0}
+        previous = {}
+        visited = set()
+        frontier = [(estimates[start_airport_id], start_airport_id)]
+        while frontier:
+            _, airport_id = heapq.heappop(frontier)
+            if airport_id == goal_airport_id:
+                break
+            if airport_id in visited:
+                continue
+            visited.add(airport_id)
+            for next_airport_id, distance in self.routes.get(airport_id, []):
+                # Every stop but the goal becomes a day's itinerary, so it needs a city to visit.
+                if next_airport_id != goal_airport_id and next_airport_id not in self.serviced_airport_ids:
+                    continue
+                next_distance = distances[airport_id] + distance
+                if next_distance < distances.get(next_airport_id, float('inf')):
+                    distances[next_airport_id] = next_distance
+                    previous[next_airport_id] = airport_id
+                    heapq.heappush(frontier, (next_distance + estimates[next_airport_id], next_airport_id))
+        if goal_airport_id not in previous:
+            return None
+        route = [goal_airport_id]
+        while route[-1] != start_airport_id:
+            route.append(previous[route[-1]])
+        route.reverse()
+        return route[1:]
+
+    def shortest_tour(self, start_airport_id, waypoint_airport_ids):
+        tour = []
+        current_airport_id = start_airport_id
+        for waypoint_airport_id in waypoint_airport_ids:
+            route = self.shortest_route(current_airport_id, waypoint_airport_id)
+            if route is None:
+                return None
+            tour.extend(route)
+            current_airport_id = waypoint_airport_id
+        return tour
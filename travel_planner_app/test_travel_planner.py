@@ -0,0 +1,702 @@
+import io
+import http.client
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stdout, redirect_stderr
+from unittest.mock import patch
+from planner import *
+from planner import main as plan_batch
+from database import *
+from distance import *
+from route_graph import *
+from world import *
+from rest import ConnectionPool
+from weather_stand_in import *
+from sqlalchemy.exc import IntegrityError
+
+
+def create_test_planner(url=Database.construct_in_memory_url()):
+    database = Database(url)
+    database.ensure_tables_exist()
+    database.ensure_version_triggers_exist()
+    return ItineraryPlanner(database)
+
+
+def add_test_airport(session, name, latitude, longitude):
+    city = City(city_name=f'{name} City', latitude=latitude, longitude=longitude,
+                encompassing_geographic_entity='example_entity')
+    airport = Airport(name=name, code='ZZZZ', latitude=latitude, longitude=longitude, cities=[city])
+    session.add(airport)
+    session.commit()
+    return airport
+
+
+def create_test_world(airport_count, url=Database.construct_in_memory_url()):
+    planner = create_test_planner(url)
+    for i in range(airport_count):
+        airport = add_test_airport(planner.session, f'Airport {i}', 0, 2 * i)
+        city = airport.cities[0]
+        for venue_type in ['Outdoor Sports Arena', 'Indoor Restaurant']:
+            requirement = Condition(min_temperature=0, max_temperature=120, min_humidity=0, max_humidity=100,
+                                    max_wind_speed=50)
+            planner.session.add(Venue(venue_name=f'{venue_type} {i}', venue_type=venue_type, cities=[city],
+                                       condition=[requirement]))
+        planner.create_new_forecasts(airport, None, generate_onecall(0, 2 * i))
+        planner.create_new_forecasts(None, city, generate_onecall(0, 2 * i))
+    planner.session.close()
+    return planner
+
+
+def start_planning(planner):
+    planner.session = planner.database.create_session(expire_on_commit=False)
+    planner.refresh_airport_graph()
+    start = planner.session.query(Airport).filter(Airport.name == 'Airport 0').one()
+    planner.final_destination = start
+    planner.destination = [0, 90]
+    return start
+
+
+def count_planning_queries(planner):
+    with planner.database.profile().operation('planning') as statistics:
+        start = start_planning(planner)
+        for day in range(1, 4):
+            planner.create_closest_itinerary_day(planner.destination, date.today() + timedelta(days=day), start)
+            planner.create_entertainment_itinerary(planner.destination, date.today() + timedelta(days=day), start)
+    return statistics.statement_count
+
+
+class TestTravelPlanner(unittest.TestCase):
+    def test_airports_within_matches_linear_scan(self):
+        planner = create_test_planner()
+        for latitude in range(-85, 90, 10):
+            for longitude in range(-175, 180, 10):
+                add_test_airport(planner.session, f'airport {latitude} {longitude}', latitude, longitude)
+        index = planner.get_airport_index()
+        for latitude, longitude in [(40.8, -96.7), (0, 179), (-84, 20), (88, -5)]:
+            expected = {airport.name for airport in planner.session.query(Airport).all()
+                        if find_distance(latitude, longitude, airport.latitude, airport.longitude) <= 3500}
+            actual = {airport.name for airport in index.airports_within(latitude, longitude, 3500)}
+            self.assertEqual(actual, expected)
+
+    def test_distance_matrix(self):
+        planner = create_test_planner()
+        lincoln = add_test_airport(planner.session, 'Lincoln Airport', 40.85, -96.76)
+        denver = add_test_airport(planner.session, 'Denver Airport', 39.86, -104.67)
+        tokyo = add_test_airport(planner.session, 'Tokyo Airport', 35.55, 139.78)
+        actual = distance_matrix([lincoln, denver, tokyo], [lincoln, tokyo])
+        self.assertEqual(actual.shape, (3, 2))
+        self.assertAlmostEqual(actual[0][0], 0)
+        self.assertAlmostEqual(actual[1][0], find_distance(39.86, -104.67, 40.85, -96.76))
+        self.assertAlmostEqual(actual[1][0], 674, delta=5)
+        self.assertAlmostEqual(actual[2][1], 0)
+
+    def test_airport_index_sees_new_airports(self):
+        planner = create_test_planner()
+        lincoln = add_test_airport(planner.session, 'Lincoln Airport', 40.85, -96.76)
+        index = planner.get_airport_index()
+        self.assertEqual(len(index), 1)
+        omaha = add_test_airport(planner.session, 'Omaha Airport', 41.3, -95.9)
+        actual = planner.get_airports_in_range(lincoln, date.today())
+        self.assertEqual([airport.name for airport in actual], ['Omaha Airport'])
+        omaha.latitude, omaha.longitude = 35.55, 139.78
+        planner.session.commit()
+        self.assertEqual(planner.get_airports_in_range(lincoln, date.today()), [])
+        self.assertEqual(index.airports_within(35.5, 139.7, 100), [omaha])
+        # Airports the other apps move or delete are caught up with at the next refresh.
+        other_session = planner.database.create_session()
+        other_session.query(Airport).filter(Airport.name == 'Omaha Airport').one().latitude = 41.3
+        other_session.commit()
+        planner.refresh_airport_graph()
+        self.assertEqual(index.airports_within(41.3, 139.7, 100), [omaha])
+        other_session.delete(other_session.query(Airport).filter(Airport.name == 'Omaha Airport').one())
+        other_session.commit()
+        planner.refresh_airport_graph()
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.airports_within(41.3, 139.7, 100), [])
+        planner.session.delete(lincoln)
+        planner.session.commit()
+        self.assertEqual(len(index), 0)
+
+    def test_airport_routes_follow_inserts(self):
+        planner = create_test_planner()
+        lincoln = add_test_airport(planner.session, 'Lincoln Airport', 40.85, -96.76)
+        add_test_airport(planner.session, 'Denver Airport', 39.86, -104.67)
+        add_test_airport(planner.session, 'Tokyo Airport', 35.55, 139.78)
+        routes = planner.session.query(AirportRoute).filter(AirportRoute.from_airport_id == lincoln.airport_id).all()
+        self.assertEqual(len(routes), 1)
+        self.assertAlmostEqual(routes[0].distance, 674, delta=5)
+        rebuilt = create_test_planner()
+        for airport in planner.session.query(Airport).all():
+            rebuilt.session.execute(Airport.__table__.insert(), {'airport_id': airport.airport_id, 'name': airport.name,
+                                                                 'latitude': airport.latitude,
+                                                                 'longitude': airport.longitude})
+        rebuilt.session.query(AirportRoute).delete()
+        build_airport_routes(rebuilt.session)
+        self.assertEqual(rebuilt.session.query(AirportRoute).count(), planner.session.query(AirportRoute).count())
+
+    def test_airport_routes_are_added_once_per_flush(self):
+        planner = create_test_planner()
+        add_test_airport(planner.session, 'Lincoln Airport', 40.85, -96.76)
+        graph = planner.get_route_graph()
+        with planner.database.profile().operation('bulk insert') as statistics:
+            planner.session.add_all([Airport(name=f'Airport {longitude}', latitude=40, longitude=longitude)
+                                     for longitude in range(-120, -60, 2)])
+            planner.session.commit()
+        # One INSERT per airport, then one read of the linked routes, one of the airports and one INSERT of the routes.
+        self.assertEqual(statistics.statement_count, 30 + 3)
+        expected = create_test_planner()
+        for airport in planner.session.query(Airport).all():
+            expected.session.execute(Airport.__table__.insert(), {'airport_id': airport.airport_id,
+                                                                  'name': airport.name, 'latitude': airport.latitude,
+                                                                  'longitude': airport.longitude})
+        expected.session.query(AirportRoute).delete()
+        build_airport_routes(expected.session)
+
+        def routes(session):
+            return sorted((route.from_airport_id, route.to_airport_id, round(route.distance, 3))
+                          for route in session.query(AirportRoute))
+
+        self.assertEqual(routes(planner.session), routes(expected.session))
+        graph.refresh(planner.session)
+        lincoln = planner.session.query(Airport).filter(Airport.name == 'Lincoln Airport').one()
+        self.assertIn(lincoln.airport_id, graph.locations)
+        planner.session.query(AirportRoute).filter(AirportRoute.to_airport_id == lincoln.airport_id).delete()
+        planner.session.delete(lincoln)
+        planner.session.commit()
+        graph.refresh(planner.session)
+        self.assertNotIn(lincoln.airport_id, graph.locations)
+        self.assertNotIn(lincoln.airport_id, {airport_id for routes in graph.routes.values()
+                                              for airport_id, _ in routes})
+        self.assertEqual(len(graph.locations), 30)
+
+    def test_closest_route_follows_shortest_path(self):
+        planner = create_test_planner()
+        start = add_test_airport(planner.session, 'Start Airport', 0, 0)
+        for longitude in range(20, 100, 20):
+            add_test_airport(planner.session, f'Hop {longitude}', 0, longitude)
+        add_test_airport(planner.session, 'Detour Airport', 25, 20)
+        goal = add_test_airport(planner.session, 'Goal Airport', 0, 100)
+        route = planner.get_route_graph().shortest_route(start.airport_id, goal.airport_id)
+        names = [planner.session.get(Airport, airport_id).name for airport_id in route]
+        self.assertEqual(names, ['Hop 20', 'Hop 40', 'Hop 60', 'Hop 80', 'Goal Airport'])
+        planner.final_destination = goal
+        planner.destination = planner.final_destination
+        actual = planner.find_next_closest_airport(start, date.today(), [0, 100])
+        self.assertEqual(actual.name, 'Hop 20')
+        actual = planner.find_next_closest_airport(actual, date.today(), [0, 100])
+        self.assertEqual(actual.name, 'Hop 40')
+
+    def test_forecast_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'forecast_cache')
+            cache = ForecastCache(path, maximum_entries=2)
+            self.assertIsNone(cache.get('onecall', 40.851, -96.759))
+            cache.put('onecall', 40.851, -96.759, {'daily': [1]})
+            cache.put('onecall', 39.86, -104.67, {'daily': [2]})
+            self.assertEqual(cache.get('onecall', 40.8512, -96.7591), {'daily': [1]})
+            cache.put('onecall', 35.55, 139.78, {'daily': [3]})
+            self.assertIsNone(cache.get('onecall', 39.86, -104.67))
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            cache.close()
+            cache = ForecastCache(path, time_to_live=0)
+            self.assertEqual(len(cache.entries), 2)
+            time.sleep(0.01)
+            self.assertIsNone(cache.get('onecall', 40.851, -96.759))
+            cache.close()
+
+    def test_rest_connection_against_stand_in(self):
+        stand_in = WeatherStandIn().start()
+        stand_in.add_place('Lincoln', 40.8, -96.7)
+        connection = stand_in.connection('/data/2.5')
+        futures = [connection.send_request_async('onecall', {'lat': latitude, 'lon': 10, 'appid': 'key'})
+                   for latitude in range(20)]
+        responses = [future.result() for future in futures]
+        self.assertEqual([len(response['daily']) for response in responses], [8] * 20)
+        self.assertEqual(responses[3], generate_onecall(3, 10))
+        self.assertLessEqual(connection.pool.connections_opened, connection.pool.size)
+        pool = connection.pool
+        larger_size = pool.size + 4
+        self.assertIs(ConnectionPool.shared(pool.authority, pool.port, larger_size, pool.secure), pool)
+        ConnectionPool.shared(pool.authority, pool.port, 1, pool.secure)
+        self.assertEqual(pool.size, larger_size)
+        slots = [pool.available.acquire(blocking=False) for _ in range(pool.size + 1)]
+        self.assertEqual(slots, [True] * pool.size + [False])
+        for _ in range(pool.size):
+            pool.available.release()
+        busy_pool = ConnectionPool(pool.authority, pool.port, 1, pool.secure)
+        busy_pool.available.acquire()
+        with self.assertRaises(TimeoutError):
+            busy_pool.request('GET', '/data/2.5/onecall', None, {}, timeout=0.05)
+        records = []
+        stand_in.connection('/geo/1.0').send_request('direct', {'q': 'Lincoln'}, None,
+                                                     lambda _, response: records.append(response), None, None)
+        self.assertEqual(records[0][0]['lat'], 40.8)
+        stand_in.error_rate = 1
+        with self.assertRaises(ConnectionError):
+            connection.request_json('onecall', {'lat': 0, 'lon': 0})
+        stand_in.stop()
+
+    def test_prefetch_city_forecasts(self):
+        stand_in = WeatherStandIn(latency=0.05).start()
+        planner = create_test_planner()
+        planner.weather_connection = stand_in.connection('/data/2.5')
+        airports = [add_test_airport(planner.session, f'Airport {i}', i, i) for i in range(8)]
+        started = time.time()
+        planner.prefetch_city_forecasts(airports)
+        self.assertLess(time.time() - started, 8 * stand_in.latency)
+        self.assertEqual(planner.session.query(Condition).count(), 8 * 8)
+        self.assertEqual(stand_in.requests_served, 8)
+        with patch.object(planner.weather_connection, 'request_json', side_effect=http.client.IncompleteRead(b'')):
+            self.assertEqual(planner.request_onecall_for_places(airports[:2]), [None, None])
+        stand_in.stop()
+
+    def test_create_new_forecasts_keeps_one_forecast_per_day(self):
+        planner = create_test_planner()
+        airport = add_test_airport(planner.session, 'Lincoln Airport', 40.85, -96.76)
+        city = airport.cities[0]
+        planner.create_new_forecasts(None, city, generate_onecall(40.85, -96.76))
+        forecasts = list(city.conditions)
+        planner.create_new_forecasts(None, city, generate_onecall(0, 0))
+        self.assertEqual(planner.session.query(Condition).filter(Condition.city_id == city.city_id).count(), 8)
+        self.assertEqual(city.conditions, forecasts)
+        expected = [row['max_temperature'] for row in forecast_rows(generate_onecall(0, 0))]
+        self.assertEqual([forecast.max_temperature for forecast in sorted(forecasts, key=lambda item: item.date)],
+                         expected)
+        planner.session.add(Condition(city=city, date=date.today()))
+        with self.assertRaises(IntegrityError):
+            planner.session.commit()
+
+    def test_planning_query_count_does_not_grow_with_airports(self):
+        small_world = create_test_world(3)
+        large_world = create_test_world(12)
+        self.assertEqual(count_planning_queries(small_world), count_planning_queries(large_world))
+        self.assertEqual(len(large_world.queued_entertainment_itineraries), 3)
+
+    def test_query_profiler_reports_operations(self):
+        planner = create_test_world(4)
+        profiler = planner.database.profile()
+        start = start_planning(planner)
+        with profiler.operation('create_new_forecasts') as statistics:
+            planner.create_new_forecasts(None, start.cities[0], generate_onecall(1, 1))
+        self.assertEqual(statistics.statement_count, 2)
+        self.assertEqual(len(statistics.slowest()), statistics.statement_count)
+        planner.create_entertainment_itinerary(planner.destination, date.today(), start)
+        planner.create_entertainment_itinerary(planner.destination, date.today() + timedelta(days=1), start)
+        statistics = profiler.operations['create_entertainment_itinerary']
+        self.assertEqual(statistics.calls, 2)
+        self.assertEqual(statistics.statement_count, 0)
+        self.assertIn('create_new_forecasts: 1 calls, 2 statements', profiler.report())
+
+    def test_query_profiler_keeps_each_threads_operations_apart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            planner = create_test_planner(f'sqlite:///{os.path.join(directory, "world.db")}')
+            profiler = planner.database.profile()
+            counts = []
+
+            def count_airports():
+                session = planner.database.create_session()
+                with profiler.operation('worker thread') as worker_statistics:
+                    session.query(Airport).count()
+                session.close()
+                counts.append(worker_statistics.statement_count)
+
+            with profiler.operation('main thread') as statistics:
+                worker = threading.Thread(target=count_airports)
+                worker.start()
+                worker.join()
+            self.assertEqual(counts, [1])
+            self.assertEqual(statistics.statement_count, 0)
+            planner.database.engine.dispose()
+
+    def test_itineraries_refer_to_places(self):
+        planner = create_test_planner()
+        lincoln = add_test_airport(planner.session, 'Lincoln Airport', 40.85, -96.76)
+        denver = add_test_airport(planner.session, 'Denver Airport', 39.86, -104.67)
+        itineraries = [Itinerary(airport=airport, airport_left_from=airport, city=airport.cities[0],
+                                 itinerary_type='Close', date=date.today() + timedelta(days=day))
+                       for day, airport in enumerate([lincoln, denver])]
+        planner.submit_data(itineraries)
+        planner.link_itineraries()
+        planner.session.close()
+        self.assertEqual(planner.get_current_location(), (40.85, -96.76))
+        actual = planner.session.query(Itinerary).filter(Itinerary.date == date.today()).one()
+        self.assertEqual(actual.next_itinerary.city.city_name, 'Denver Airport City')
+        self.assertEqual(actual.airport_left_from_id, lincoln.airport_id)
+
+    def test_unit_of_work_commits_a_batch_once(self):
+        planner = create_test_planner()
+        airport = add_test_airport(planner.session, 'Lincoln Airport', 40.85, -96.76)
+        city = airport.cities[0]
+        unit_of_work = planner.get_unit_of_work()
+        with unit_of_work.batch():
+            planner.create_new_forecasts(None, city, generate_onecall(40.85, -96.76))
+            planner.create_new_forecasts(airport, None, generate_onecall(40.85, -96.76))
+        self.assertEqual((unit_of_work.commits, unit_of_work.commits_saved), (1, 1))
+        with self.assertRaises(IntegrityError):
+            with unit_of_work.batch():
+                planner.submit_data(Condition(city=city, date=date.today() + timedelta(days=30)))
+                planner.submit_data(Condition(city=city, date=date.today()))
+        self.assertEqual(planner.session.query(Condition).count(), 16)
+        planner.delete_row(city.conditions[:2])
+        self.assertEqual(planner.session.query(Condition).count(), 14)
+        self.assertEqual(str(unit_of_work), '2 commits for 5 requested, 3 saved')
+
+    def test_planning_context_memoizes_city_scores(self):
+        planner = create_test_world(3)
+        start = start_planning(planner)
+        context = planner.get_planning_context()
+        city = start.cities[0]
+        for _ in range(3):
+            score = planner.get_city_score(city, date.today())
+        self.assertEqual((context.hits, context.misses), (2, 1))
+        planner.determine_best_city(start, date.today())
+        self.assertEqual(context.hits, 3)
+        planner.create_new_forecasts(None, city, generate_onecall(1, 1))
+        self.assertIsNone(context.score(city.city_id, date.today()))
+        self.assertEqual(planner.get_planning_context().forecast(city, date.today()).date, date.today())
+        planner.session.add(Condition(city=city, date=date.today() + timedelta(days=30)))
+        planner.session.flush()
+        self.assertNotIn(city.city_id, context.forecasts)
+        self.assertEqual(str(context), '3 hits, 3 misses, 50% hit rate')
+        self.assertIsInstance(score, int)
+
+    def test_city_scores_are_kept_until_their_forecasts_or_venues_change(self):
+        planner = create_test_world(3)
+        start = start_planning(planner)
+        context = planner.get_planning_context()
+        city = start.cities[0]
+        city.conditions[0].max_temperature = 35
+        city.conditions[0].max_wind_speed = 5
+        planner.session.commit()
+        planner.start_run()
+        score = planner.get_city_score(city, planner.current_date)
+        self.assertEqual(score, 5)
+        planner.start_run()
+        self.assertEqual(context.score(city.city_id, planner.current_date), score)
+        other_session = planner.database.create_session()
+        other_session.get(Airport, start.airport_id).conditions[0].max_temperature += 1
+        other_session.commit()
+        planner.start_run()
+        self.assertEqual(context.score(city.city_id, planner.current_date), score)
+        other_city = other_session.get(City, city.city_id)
+        other_city.conditions[-1].date += timedelta(days=30)
+        other_session.commit()
+        planner.start_run()
+        self.assertIsNone(context.score(city.city_id, planner.current_date))
+        self.assertEqual(planner.get_city_score(city, planner.current_date), score)
+        other_city.conditions[0].max_wind_speed += 1
+        other_session.commit()
+        other_session.close()
+        planner.start_run()
+        self.assertIsNone(context.score(city.city_id, planner.current_date))
+        score = planner.get_city_score(city, planner.current_date)
+        venue = Venue(venue_name='Late Venue', venue_type='Indoor Theater', cities=[city])
+        planner.session.add(venue)
+        planner.session.flush()
+        self.assertIsNone(context.score(city.city_id, planner.current_date))
+        planner.score_cities(start.cities, planner.current_date)
+        self.assertEqual(planner.get_city_score(city, planner.current_date), score + 1)
+        venue.cities = []
+        planner.session.flush()
+        self.assertIsNone(context.score(city.city_id, planner.current_date))
+        self.assertEqual(planner.get_city_score(city, planner.current_date), score)
+
+    def test_airport_weather_flags_follow_forecast_writes(self):
+        planner = create_test_world(3)
+        start = start_planning(planner)
+        weather = planner.get_airport_weather()
+
+        def is_ok(airport, current_date):
+            forecasts = [forecast for forecast in airport.conditions
+                         if forecast.date == current_date + timedelta(days=1)]
+            return not airport.conditions or any(forecast.max_temperature < 45 and forecast.visibility > 5
+                                                 for forecast in forecasts)
+
+        dates = [date.today() + timedelta(days=day) for day in range(-1, 9)]
+        self.assertEqual([weather.is_ok(start, day) for day in dates], [is_ok(start, day) for day in dates])
+        self.assertIn(start.airport_id, weather.airports)
+        for latitude in range(10):
+            planner.create_new_forecasts(start, None, generate_onecall(latitude, 7))
+            self.assertNotIn(start.airport_id, weather.airports)
+            self.assertEqual([weather.is_ok(start, day) for day in dates], [is_ok(start, day) for day in dates])
+        start.conditions[0].visibility = 0
+        planner.session.flush()
+        self.assertFalse(weather.is_ok(start, start.conditions[0].date - timedelta(days=1)))
+        airport = add_test_airport(planner.session, 'Airport 3', 0, 6)
+        self.assertTrue(weather.is_ok(airport, date.today()))
+
+    def test_batch_planning_streams_one_json_line_per_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f'sqlite:///{os.path.join(directory, "world.db")}'
+            create_test_world(4, url)
+            arguments = ['planner.py', '--database-url', url, '--days', '2',
+                         '--forecast-cache', os.path.join(directory, 'forecast_cache'),
+                         '--snapshot', os.path.join(directory, 'world_snapshot'),
+                         '--trip', 'Airport 0', date.today().isoformat(),
+                         '--trip', 'Missing Airport', date.today().isoformat()]
+            output = io.StringIO()
+            with patch('sys.argv', arguments), redirect_stdout(output), redirect_stderr(io.StringIO()):
+                plan_batch()
+            records = [json.loads(line) for line in output.getvalue().splitlines()]
+            self.assertEqual([len(records[0]['closest']), len(records[0]['entertainment'])], [2, 2])
+            self.assertEqual(records[0]['closest'][0]['date'], (date.today() + timedelta(days=1)).isoformat())
+            self.assertIn('NoResultFound', records[1]['error'])
+            self.assertEqual(create_test_planner(url).session.query(Itinerary).count(), 0)
+
+    def test_parallel_planning_matches_sequential_planning(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f'sqlite:///{os.path.join(directory, "world.db")}'
+            create_test_world(6, url)
+            trips = [{'airport': f'Airport {i}', 'date': date.today().isoformat(), 'days': 2} for i in range(3)]
+            planner = create_test_planner(url)
+            planner.start_run()
+            sequential = [plan_trip_record(planner, trip, PLANNING_DAYS) for trip in trips]
+            parallel = list(plan_trips_in_parallel(url, trips, processes=2))
+            for records in (sequential, parallel):
+                for record in records:
+                    del record['seconds']
+                    record.pop('forecasts', None)
+            self.assertEqual(parallel, sequential)
+            planner.save_trip_plans(parallel)
+            self.assertEqual(planner.get_unit_of_work().commits, 1)
+            itineraries = planner.session.query(Itinerary).filter(Itinerary.itinerary_type == 'Close').all()
+            self.assertEqual(len(itineraries), 6)
+            self.assertEqual(sum(itinerary.next_itinerary is not None for itinerary in itineraries), 3)
+
+    def test_read_only_planner_keeps_fetched_forecasts_in_memory(self):
+        planner = create_test_world(1)
+        planner.session = planner.database.create_session(expire_on_commit=False)
+        planner.read_only = True
+        planner.session.query(City).one().conditions = []
+        planner.session.commit()
+        city = planner.load_world().cities[0]
+        planner.create_new_forecasts(None, city, generate_onecall(0, 0))
+        self.assertEqual(len(city.conditions), 8)
+        self.assertEqual(planner.session.query(Condition).filter(Condition.city_id == city.city_id).count(), 0)
+        planner.save_trip_plans([{'forecasts': planner.fetched_forecasts}])
+        self.assertEqual(planner.session.query(Condition).filter(Condition.city_id == city.city_id).count(), 8)
+
+    def test_world_mirrors_the_database_without_issuing_sql(self):
+        planner = create_test_world(3)
+        planner.session = planner.database.create_session(expire_on_commit=False)
+        planner.read_only = True
+        planner.start_run()
+        airport = planner.session.query(Airport).filter(Airport.name == 'Airport 1').one()
+        world_airport = planner.world.airport(airport.airport_id)
+        self.assertEqual((world_airport.name, world_airport.latitude, world_airport.longitude),
+                         (airport.name, airport.latitude, airport.longitude))
+        self.assertEqual([city.city_name for city in world_airport.cities], [city.city_name for city in airport.cities])
+        city, world_city = airport.cities[0], world_airport.cities[0]
+        self.assertEqual(sorted(venue.venue_name for venue in world_city.venues),
+                         sorted(venue.venue_name for venue in city.venues))
+        self.assertEqual(world_city.venues[0].condition[0].max_wind_speed, 50)
+        self.assertEqual([(forecast.date, forecast.max_temperature) for forecast in world_city.conditions],
+                         [(forecast.date, forecast.max_temperature) for forecast in city.conditions])
+        self.assertIs(world_city.airports[0], world_airport)
+        with planner.database.profile().operation('planning') as statistics:
+            record = plan_trip_record(planner, {'airport': 'Airport 0', 'date': date.today().isoformat()}, 3)
+        self.assertEqual(len(record['closest']), 3)
+        self.assertEqual(statistics.statement_count, 0)
+
+    def test_world_snapshot_is_reused_until_the_tables_change(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'world_snapshot')
+            planner = create_test_world(3)
+            world = World.cached(planner.session, path)
+            with planner.database.profile().operation('warm start') as statistics:
+                mapped_world = World.cached(planner.session, path)
+            self.assertEqual(statistics.statement_count, 1)
+            self.assertEqual([city.city_name for city in mapped_world.airports[2].cities],
+                             [city.city_name for city in world.airports[2].cities])
+            self.assertEqual(mapped_world.airports[2].longitude, 4)
+            self.assertEqual(mapped_world.cities[1].venues[0].condition[0].max_temperature, 120)
+            self.assertEqual([(forecast.date, forecast.max_temperature, forecast.min_humidity)
+                              for forecast in mapped_world.cities[1].conditions],
+                             [(forecast.date, forecast.max_temperature, forecast.min_humidity)
+                              for forecast in world.cities[1].conditions])
+            add_test_airport(planner.session, 'Airport 3', 0, 6)
+            self.assertIsNone(World.open(path, world_fingerprint(planner.session)))
+            self.assertIn('Airport 3', World.cached(planner.session, path).airport_names)
+            # Edits that keep every count and total the same are still seen.
+            planner.session.query(City).filter(City.city_name == 'Airport 1 City').one().city_name = 'Airport 9 City'
+            planner.session.commit()
+            self.assertIn('Airport 9 City', [city.city_name for city in World.cached(planner.session, path).cities])
+            first_venue, second_venue = planner.session.query(Venue).order_by(Venue.venue_id).all()[:2]
+            first_venue.venue_type, second_venue.venue_type = second_venue.venue_type, first_venue.venue_type
+            planner.session.commit()
+            self.assertEqual([venue.venue_type for venue in World.cached(planner.session, path).venues[:2]],
+                             [first_venue.venue_type, second_venue.venue_type])
+            fingerprint = world_fingerprint(planner.session)
+            planner.session.execute(Condition.__table__.update().values(rain=Condition.rain))
+            self.assertNotEqual(world_fingerprint(planner.session), fingerprint)
+            # Without the counters every row is hashed instead, which still tells a changed table from an unchanged one.
+            planner.session.execute(TableVersion.__table__.delete())
+            fingerprint = world_fingerprint(planner.session)
+            self.assertIsNotNone(fingerprint)
+            self.assertEqual(world_fingerprint(planner.session), fingerprint)
+            self.assertEqual(len(World.cached(planner.session, path).airports), 4)
+            planner.session.query(City).filter(City.city_name == 'Airport 9 City').one().latitude = 1
+            planner.session.commit()
+            self.assertNotEqual(world_fingerprint(planner.session), fingerprint)
+            tomorrow = date.today() + timedelta(days=1)
+            recent_world = World.cached(planner.session, path, tomorrow)
+            self.assertEqual([forecast.date for forecast in recent_world.cities[0].conditions],
+                             [forecast.date for forecast in world.cities[0].conditions if forecast.date >= tomorrow])
+            self.assertLess(len(recent_world.cities[0].conditions), len(world.cities[0].conditions))
+            self.assertIsNone(World.open(path, world_fingerprint(planner.session)))
+
+    def test_entertainment_route_beam_search(self):
+        planner = create_test_world(12)
+        start = start_planning(planner)
+        first_date = date.today() + timedelta(days=1)
+
+        def plan(beam_width, time_budget=60):
+            planner.beam_width = beam_width
+            planner.time_budget = time_budget
+            route = planner.optimize_entertainment_route(start, first_date, 5)
+            return route, sum(planner.get_city_score(city, first_date + timedelta(days=day))
+                              for day, (_, city) in enumerate(route))
+
+        greedy_route, greedy_score = plan(1)
+        beam_route, beam_score = plan(8)
+        self.assertEqual(len(beam_route), 5)
+        self.assertGreaterEqual(beam_score, greedy_score)
+        self.assertEqual(plan(8, time_budget=0), (greedy_route, greedy_score))
+        # Each expansion takes a second, so the budget runs out partway through the second day.
+        clock = [0]
+        expansions = []
+        next_entertainment_airports = planner.next_entertainment_airports
+
+        def slow_next_entertainment_airports(*args):
+            expansions.append(args)
+            clock[0] += 1
+            return next_entertainment_airports(*args)
+
+        with patch('planner.time.perf_counter', lambda: clock[0]), \
+                patch.object(planner, 'next_entertainment_airports', slow_next_entertainment_airports):
+            route, _ = plan(8, time_budget=3)
+        self.assertEqual(len(route), 5)
+        self.assertEqual(len(expansions), 6)
+
+    def test_prepare_itineraries_replans_only_what_changed(self):
+        stand_in = WeatherStandIn().start()
+        planner = create_test_world(12)
+        planner.weather_connection = stand_in.connection('/data/2.5')
+        start_planning(planner)
+        planner.prepare_itineraries()
+        self.assertEqual([len(planner.queued_closest_itineraries), len(planner.queued_entertainment_itineraries)],
+                         [7, 7])
+        planner.submit_queued_itineraries()
+        commits = planner.get_unit_of_work().commits
+        planner.prepare_itineraries()
+        self.assertEqual([planner.queued_closest_itineraries, planner.queued_entertainment_itineraries], [[], []])
+        self.assertEqual(planner.get_unit_of_work().commits, commits)
+
+        removed_date = date.today() + timedelta(days=3)
+        planner.session.query(Itinerary).filter(Itinerary.itinerary_type == 'Close',
+                                                Itinerary.date == removed_date).delete()
+        planner.session.commit()
+        planner.prepare_itineraries()
+        self.assertEqual(planner.queued_entertainment_itineraries, [])
+        self.assertEqual(planner.queued_closest_itineraries[0].date, removed_date)
+        planner.submit_queued_itineraries()
+        closest_itineraries = planner.session.query(Itinerary).filter(Itinerary.itinerary_type == 'Close').order_by(
+            Itinerary.date).all()
+        self.assertEqual([itinerary.date for itinerary in closest_itineraries],
+                         [date.today() + timedelta(days=day) for day in range(1, 8)])
+        for itinerary, next_itinerary in zip(closest_itineraries, closest_itineraries[1:]):
+            self.assertIs(itinerary.next_itinerary, next_itinerary)
+
+        changed_itinerary = planner.session.query(Itinerary).filter(
+            Itinerary.itinerary_type == 'Entertain', Itinerary.date == date.today() + timedelta(days=5)).one()
+        forecast = planner.session.query(Condition).filter(Condition.airport_id == changed_itinerary.airport_id,
+                                                           Condition.date == changed_itinerary.date).one()
+        expected_temperature = forecast.max_temperature
+        forecast.max_temperature += 1
+        planner.session.commit()
+        planner.prepare_itineraries()
+        self.assertEqual(forecast.max_temperature, expected_temperature)
+        self.assertTrue(all(itinerary.date >= changed_itinerary.date - timedelta(days=1)
+                            for itinerary in planner.queued_entertainment_itineraries))
+
+        # Deleting an airport clears it from the itineraries that visited it, which the next session plans again.
+        cleared_date = date.today() + timedelta(days=2)
+        planner.session.query(Itinerary).filter(Itinerary.itinerary_type == 'Close',
+                                                Itinerary.date == cleared_date).update({'airport_id': None})
+        planner.session.commit()
+        planner.discard_queued_itineraries()
+        start_planning(planner)
+        planner.prepare_itineraries()
+        self.assertEqual(planner.queued_closest_itineraries[0].date, cleared_date)
+        self.assertIsNotNone(planner.queued_closest_itineraries[0].airport)
+        self.assertIn(cleared_date, [itinerary.date for itinerary in planner.replaced_itineraries])
+        stand_in.stop()
+
+    def test_determine_venues_picks_the_last_open_venue_of_each_type(self):
+        planner = create_test_planner()
+        city = add_test_airport(planner.session, 'Airport 0', 0, 0).cities[0]
+        venue_types = ['Indoor Restaurant', 'Outdoor Restaurant', 'Indoor Theater', 'Outdoor Theater',
+                       'Indoor Sports Arena', 'Outdoor Sports Arena']
+        generator = random.Random(7)
+        for i in range(60):
+            planner.session.add(Venue(venue_name=f'Venue {i}', venue_type=generator.choice(venue_types), cities=[city]))
+        planner.session.commit()
+
+        def last_open(open_venues, types):
+            matches = [venue for venue in open_venues if venue.venue_type in types]
+            return matches[-1] if matches else None
+
+        for _ in range(50):
+            open_venues = [venue for venue in city.venues if generator.random() < 0.2]
+            planner.outdoor_plays, planner.outdoor_sporting_events = generator.choice([(0, 0), (0, 1)])
+            event_types = [['Outdoor Sports Arena'], ['Outdoor Theater']]
+            if planner.outdoor_plays < planner.outdoor_sporting_events:
+                event_types.reverse()
+            event = None
+            for types in event_types + [['Indoor Theater', 'Indoor Sports Arena']]:
+                event = event or last_open(open_venues, types)
+            restaurant = last_open(open_venues, ['Outdoor Restaurant'])
+            if event is None:
+                restaurant = last_open(open_venues, ['Indoor Restaurant']) or restaurant
+            expected = [venue for venue in (event, restaurant) if venue is not None]
+            self.assertEqual(planner.determine_venues(city, open_venues), expected)
+
+    def test_venue_requirements_are_matched_against_forecasts_as_arrays(self):
+        planner = create_test_planner()
+        cities = [add_test_airport(planner.session, f'Airport {i}', 0, 2 * i).cities[0] for i in range(3)]
+        generator = random.Random(11)
+        for i in range(90):
+            requirement = Condition(min_temperature=generator.randint(0, 60),
+                                    max_temperature=generator.randint(50, 110),
+                                    min_humidity=generator.randint(0, 50),
+                                    max_humidity=generator.randint(40, 100),
+                                    max_wind_speed=generator.randint(5, 30))
+            planner.session.add(Venue(venue_name=f'Venue {i}', venue_type='Indoor Theater', cities=[cities[i % 3]],
+                                      condition=[requirement] if i % 4 else []))
+        planner.session.commit()
+
+        def is_open(venue, forecast):
+            if not venue.condition:
+                return True
+            requirement = venue.condition[0]
+            return requirement.min_temperature <= forecast.max_temperature <= requirement.max_temperature and \
+                requirement.min_humidity <= forecast.max_humidity <= requirement.max_humidity and \
+                forecast.max_wind_speed <= requirement.max_wind_speed
+
+        catalog = planner.get_venue_catalog()
+        for _ in range(30):
+            forecasts = [Condition(max_temperature=generator.randint(0, 110), max_humidity=generator.randint(0, 100),
+                                   max_wind_speed=generator.randint(0, 30)) for _ in cities]
+            expected = [[venue for venue in city.venues if is_open(venue, forecast)]
+                        for city, forecast in zip(cities, forecasts)]
+            self.assertEqual([catalog.open_venues(city, forecast) for city, forecast in zip(cities, forecasts)],
+                             expected)
+            self.assertEqual(list(catalog.count_open_venues(cities, forecasts)), [len(venues) for venues in expected])
+
+
+if __name__ == '__main__':
+    unittest.main()
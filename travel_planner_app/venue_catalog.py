@@ -0,0 +1,108 @@
+import numpy
+from sqlalchemy import event
+from database import Condition, Venue
+
+REQUIREMENT_COLUMNS = ('min_temperature', 'max_temperature', 'min_humidity', 'max_humidity', 'max_wind_speed')
+
+
+def open_venue_mask(requirements, max_temperatures, max_humidities, max_wind_speeds):
+    # requirements has one row per REQUIREMENT_COLUMNS and one column per venue; the forecast values are either one
+    # number or one per venue.
+    return (requirements[0] <= max_temperatures) & (max_temperatures <= requirements[1]) & \
+        (requirements[2] <= max_humidities) & (max_humidities <= requirements[3]) & \
+        (max_wind_speeds <= requirements[4])
+
+
+def forecast_values(forecasts):
+    # NULL becomes NaN, which no requirement accepts.
+    return [numpy.array([numpy.nan if getattr(forecast, column) is None else getattr(forecast, column)
+                         for forecast in forecasts], dtype=float)
+            for column in ('max_temperature', 'max_humidity', 'max_wind_speed')]
+
+
+class VenueCatalog(object):
+    # Each city's venues grouped by type, and their weather requirements as arrays, in the city's order. Both are
+    # built the first time the city is asked about in a planning run and forgotten when venues are written.
+    def __init__(self):
+        self.cities = {}
+        self.city_venues = {}
+        self.city_requirements = {}
+
+    @staticmethod
+    def of(session):
+        if 'venue_catalog' not in session.info:
+            session.info['venue_catalog'] = VenueCatalog()
+            event.listen(session, 'after_flush', session.info['venue_catalog'].on_flush)
+        return session.info['venue_catalog']
+
+    def on_flush(self, session, _):
+        for item in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(item, Venue) or \
+                    isinstance(item, Condition) and item.city_id is None and item.airport_id is None:
+                self.reset()
+                return
+
+    def reset(self):
+        self.cities = {}
+        self.city_venues = {}
+        self.city_requirements = {}
+
+    def venues(self, city):
+        if city.city_id not in self.city_venues:
+            self.city_venues[city.city_id] = list(city.venues)
+        return self.city_venues[city.city_id]
+
+    def requirements(self, city):
+        # A venue without requirements is open in any weather, and a missing bound is never met.
+        if city.city_id not in self.city_requirements:
+            venues = self.venues(city)
+            requirements = numpy.empty((len(REQUIREMENT_COLUMNS), len(venues)))
+            requirements[0::2] = -numpy.inf
+            requirements[1::2] = numpy.inf
+            requirements[4] = numpy.inf
+            for index, venue in enumerate(venues):
+                if venue.condition:
+                    requirements[:, index] = [numpy.nan if getattr(venue.condition[0], column) is None
+                                              else getattr(venue.condition[0], column)
+                                              for column in REQUIREMENT_COLUMNS]
+            self.city_requirements[city.city_id] = requirements
+        return self.city_requirements[city.city_id]
+
+    def open_venues(self, city, forecast):
+        max_temperatures, max_humidities, max_wind_speeds = forecast_values([forecast])
+        mask = open_venue_mask(self.requirements(city), max_temperatures[0], max_humidities[0], max_wind_speeds[0])
+        venues = self.venues(city)
+        return [venues[index] for index in numpy.flatnonzero(mask)]
+
+    def count_open_venues(self, cities, forecasts):
+        # How many of each city's venues are open in the forecast given for it, in one evaluation over all of them.
+        requirements = [self.requirements(city) for city in cities]
+        venue_counts = [venue_requirements.shape[1] for venue_requirements in requirements]
+        max_temperatures, max_humidities, max_wind_speeds = (numpy.repeat(values, venue_counts)
+                                                            for values in forecast_values(forecasts))
+        mask = open_venue_mask(numpy.concatenate(requirements, axis=1), max_temperatures, max_humidities,
+                               max_wind_speeds)
+        return numpy.bincount(numpy.repeat(numpy.arange(len(cities)), venue_counts), weights=mask,
+                              minlength=len(cities)).astype(int)
+
+    def venue_types(self, city):
+        if city.city_id not in self.cities:
+            venue_types = {}
+            for position, venue in enumerate(self.venues(city)):
+                venue_types.setdefault(venue.venue_type, []).append((position, venue))
+            self.cities[city.city_id] = venue_types
+        return self.cities[city.city_id]
+
+    def last_open_venue(self, city, venue_types, open_venues):
+        # The open venue of any of the types that comes last in the city's venues, or None.
+        last_position = -1
+        last_venue = None
+        catalog = self.venue_types(city)
+        for venue_type in venue_types:
+            for position, venue in reversed(catalog.get(venue_type, ())):
+                if venue in open_venues:
+                    if position > last_position:
+                        last_position = position
+                        last_venue = venue
+                    break
+        return last_venue
@@ -0,0 +1,172 @@
+import argparse
+import gzip
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from rest import RESTConnection
+
+ONECALL_PATH = '/data/2.5/onecall'
+DIRECT_PATH = '/geo/1.0/direct'
+
+
+class WeatherStandIn(object):
+    # Serves the two OpenWeather endpoints the apps use from fixtures, so they can be exercised offline.
+    def __init__(self, port=0, fixture_directory=None, latency=0, error_rate=0, seed=None, upstream=None):
+        self.fixture_directory = fixture_directory
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.upstream = upstream
+        self.places = {}
+        self.requests_served = 0
+        self.errors_injected = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), StandInRequestHandler)
+        self.server.daemon_threads = True
+        self.server.stand_in = self
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def connection(self, root_path, **kwargs):
+        return RESTConnection('127.0.0.1', self.port, root_path, secure=False, **kwargs)
+
+    def add_place(self, name, latitude, longitude, country='US'):
+        self.places[name] = {'name': name, 'lat': latitude, 'lon': longitude, 'country': country}
+
+    def should_fail(self):
+        with self.lock:
+            self.requests_served += 1
+            if self.random.random() < self.error_rate:
+                self.errors_injected += 1
+                return True
+            return False
+
+    def respond(self, path, parameters):
+        # Returns the status and JSON body for a request, recording upstream responses as new fixtures.
+        if path == ONECALL_PATH:
+            name = f'onecall_{float(parameters["lat"]):.2f}_{float(parameters["lon"]):.2f}'
+        elif path == DIRECT_PATH:
+            name = f'direct_{parameters.get("q", "")}'
+        else:
+            return 404, {'cod': 404, 'message': 'Not found'}
+        fixture = self.load_fixture(name)
+        if fixture is not None:
+            return 200, fixture
+        if self.upstream is not None:
+            response = self.upstream.request_json(path.lstrip('/'), parameters)
+            self.save_fixture(name, response)
+            return 200, response
+        if path == ONECALL_PATH:
+            return 200, generate_onecall(float(parameters['lat']), float(parameters['lon']))
+        query = parameters.get('q', '')
+        return 200, [self.places[query]] if query in self.places else []
+
+    def fixture_path(self, name):
+        return os.path.join(self.fixture_directory, ''.join(
+            character if character.isalnum() or character in '._-' else '_' for character in name) + '.json')
+
+    def load_fixture(self, name):
+        if self.fixture_directory is None or not os.path.exists(self.fixture_path(name)):
+            return None
+        with open(self.fixture_path(name)) as fixture:
+            return json.load(fixture)
+
+    def save_fixture(self, name, response):
+        if self.fixture_directory is not None:
+            os.makedirs(self.fixture_directory, exist_ok=True)
+            with open(self.fixture_path(name), 'w') as fixture:
+                json.dump(response, fixture)
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+        parts = urlsplit(self.path)
+        parameters = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        if stand_in.should_fail():
+            status, response = 500, {'cod': 500, 'message': 'Injected error'}
+        else:
+            try:
+                status, response = stand_in.respond(parts.path, parameters)
+            except (http.client.HTTPException, KeyError, ValueError, OSError) as error:
+                status, response = 400, {'cod': 400, 'message': str(error)}
+        body = json.dumps(response).encode('UTF8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def generate_onecall(latitude, longitude, start=None):
+    # The same coordinates always produce the same forecast, so benchmark runs are repeatable.
+    generator = random.Random(f'{latitude:.2f},{longitude:.2f}')
+    start = start if start is not None else date.today()
+    daily = []
+    for day in range(8):
+        noon = datetime.combine(start + timedelta(days=day), datetime.min.time()) + timedelta(hours=12)
+        low = generator.randint(10, 80)
+        daily.append({
+            'dt': int(noon.timestamp()),
+            'temp': {'min': low, 'max': low + generator.randint(0, 25)},
+            'humidity': generator.randint(0, 100),
+            'wind_speed': generator.randint(0, 30),
+            'pop': generator.random(),
+            'weather': [{'id': generator.choice([200, 300, 500, 600, 741, 800, 801])}]
+        })
+    hourly = []
+    for hour in range(48):
+        moment = datetime.combine(start, datetime.min.time()) + timedelta(hours=hour)
+        hourly.append({'dt': int(moment.timestamp()), 'visibility': generator.choice([10000, 10000, 10000, 3000])})
+    return {'lat': latitude, 'lon': longitude, 'daily': daily, 'hourly': hourly}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve OpenWeather onecall and geocoding responses locally.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fixtures', help='directory of recorded responses to replay')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before every response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail with 500')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--record', action='store_true', help='fetch missing fixtures from OpenWeather and save them')
+    arguments = parser.parse_args()
+    upstream = RESTConnection('api.openweathermap.org', 443, '') if arguments.record else None
+    stand_in = WeatherStandIn(arguments.port, arguments.fixtures, arguments.latency, arguments.error_rate,
+                              arguments.seed, upstream)
+    print(f'Serving OpenWeather stand-in on http://127.0.0.1:{stand_in.port}')
+    try:
+        stand_in.server.serve_forever()
+    except KeyboardInterrupt:
+        stand_in.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+import json
+import os
+import struct
+import numpy
+from datetime import date
+from numpy.lib.format import dtype_to_descr, descr_to_dtype
+from sqlalchemy import select
+from sqlalchemy.orm.exc import NoResultFound
+from database import Airport, AirportCity, City, CityVenue, Condition, Venue, VenueCondition, TABLE_VERSION_NAMES, \
+    table_fingerprint
+
+CONDITION_COLUMNS = ('condition_id', 'city_id', 'airport_id', 'date', 'min_temperature', 'max_temperature',
+                     'min_humidity', 'max_humidity', 'max_wind_speed', 'visibility', 'rain')
+# Ids and dates are stored as integers with -1 for NULL, and measurements as floats with NaN for NULL.
+CONDITION_DTYPE = numpy.dtype([('condition_id', '<i8'), ('city_id', '<i8'), ('airport_id', '<i8'), ('date', '<i8')] +
+                              [(column, '<f8') for column in CONDITION_COLUMNS[4:]])
+SNAPSHOT_MAGIC = b'TPWORLD\0'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGNMENT = 8
+
+
+def optional_float(value):
+    return None if numpy.isnan(value) else float(value)
+
+
+def encode_condition(condition):
+    row = [-1 if getattr(condition, column) is None else getattr(condition, column) for column in CONDITION_COLUMNS[:3]]
+    row.append(-1 if condition.date is None else condition.date.toordinal())
+    row.extend(numpy.nan if getattr(condition, column) is None else getattr(condition, column)
+               for column in CONDITION_COLUMNS[4:])
+    return tuple(row)
+
+
+def decode_condition(row):
+    values = {column: None if value == -1 else value for column, value in zip(CONDITION_COLUMNS[:3], row)}
+    values['date'] = None if row[3] == -1 else date.fromordinal(row[3])
+    values.update((column, None if numpy.isnan(value) else int(value)) for column, value in zip(CONDITION_COLUMNS[4:],
+                                                                                               row[4:]))
+    return WorldCondition(**values)
+
+
+def list_offsets(lists):
+    offsets = numpy.zeros(len(lists) + 1, dtype='<i8')
+    offsets[1:] = numpy.cumsum([len(items) for items in lists])
+    return offsets
+
+
+def compressed_rows(lists):
+    # Stores a list of index lists as one flat array plus where each list starts, so the lists map without copying.
+    offsets = list_offsets(lists)
+    indices = numpy.fromiter((index for indices in lists for index in indices), dtype='<i4', count=int(offsets[-1]))
+    return offsets, indices
+
+
+def world_fingerprint(session, since=None):
+    # Changes with every write to a table the World reads, and with the first date of the forecasts it keeps.
+    fingerprint = table_fingerprint(session, TABLE_VERSION_NAMES)
+    return fingerprint if since is None else f'{fingerprint} {since.isoformat()}'
+
+
+def aligned(position):
+    return (position + SNAPSHOT_ALIGNMENT - 1) // SNAPSHOT_ALIGNMENT * SNAPSHOT_ALIGNMENT
+
+
+class WorldCondition(object):
+    # A forecast or a venue's weather requirement, with the same attribute names as Condition.
+    __slots__ = CONDITION_COLUMNS
+
+    def __init__(self, **values):
+        for column in CONDITION_COLUMNS:
+            setattr(self, column, values.get(column))
+
+
+class WorldPlace(object):
+    # Forecasts mapped from a snapshot are only turned into WorldConditions once the place's conditions are read.
+    __slots__ = ('world', 'index', 'forecast_rows', 'loaded_conditions')
+
+    def __init__(self, world, index):
+        self.world = world
+        self.index = index
+        self.forecast_rows = None
+        self.loaded_conditions = []
+
+    @property
+    def conditions(self):
+        if self.loaded_conditions is None:
+            self.loaded_conditions = [decode_condition(row) for row in self.forecast_rows.tolist()]
+        return self.loaded_conditions
+
+    @conditions.setter
+    def conditions(self, conditions):
+        self.loaded_conditions = conditions
+
+
+class WorldAirport(WorldPlace):
+    __slots__ = ('airport_id', 'name', 'city_indices')
+
+    def __init__(self, world, index, airport_id, name):
+        super(WorldAirport, self).__init__(world, index)
+        self.airport_id = airport_id
+        self.name = name
+        self.city_indices = []
+
+    @property
+    def latitude(self):
+        return optional_float(self.world.airport_latitudes[self.index])
+
+    @property
+    def longitude(self):
+        return optional_float(self.world.airport_longitudes[self.index])
+
+    @property
+    def cities(self):
+        return tuple(self.world.cities[index] for index in self.city_indices)
+
+
+class WorldCity(WorldPlace):
+    __slots__ = ('city_id', 'city_name', 'airport_indices', 'venue_indices')
+
+    def __init__(self, world, index, city_id, city_name):
+        super(WorldCity, self).__init__(world, index)
+        self.city_id = city_id
+        self.city_name = city_name
+        self.airport_indices = []
+        self.venue_indices = []
+
+    @property
+    def latitude(self):
+        return float(self.world.city_latitudes[self.index])
+
+    @property
+    def longitude(self):
+        return float(self.world.city_longitudes[self.index])
+
+    @property
+    def airports(self):
+        return tuple(self.world.airports[index] for index in self.airport_indices)
+
+    @property
+    def venues(self):
+        return tuple(self.world.venues[index] for index in self.venue_indices)
+
+
+class WorldVenue(object):
+    __slots__ = ('world', 'index', 'venue_id', 'venue_name', 'venue_type', 'requirement_index')
+
+    def __init__(self, world, index, venue_id, venue_name, venue_type):
+        self.world = world
+        self.index = index
+        self.venue_id = venue_id
+        self.venue_name = venue_name
+        self.venue_type = venue_type
+        self.requirement_index = None
+
+    @property
+    def condition(self):
+        if self.requirement_index is None:
+            return ()
+        return self.world.requirements[self.requirement_index],
+
+
+class WorldItinerary(object):
+    # What the planner queues when it plans from a World, which has no ORM objects to put in an Itinerary.
+    __slots__ = ('airport', 'airport_left_from', 'city', 'venues', 'date', 'itinerary_type', 'next_itinerary',
+                 'selected')
+
+    def __init__(self, airport, city, venues, date, itinerary_type, airport_left_from):
+        self.airport = airport
+        self.airport_left_from = airport_left_from
+        self.city = city
+        self.venues = venues
+        self.date = date
+        self.itinerary_type = itinerary_type
+        self.next_itinerary = None
+        self.selected = False
+
+
+class World(object):
+    # A read-only copy of the airports, cities, venues and forecasts the planner walks, loaded in one pass. Places keep
+    # their coordinates in arrays and their neighbours as indexes, and answer to the same attribute names as the ORM
+    # models, so the planning helpers accept either.
+    def __init__(self):
+        self.airports = []
+        self.cities = []
+        self.venues = []
+        self.requirements = []
+        self.airport_latitudes = numpy.empty(0)
+        self.airport_longitudes = numpy.empty(0)
+        self.city_latitudes = numpy.empty(0)
+        self.city_longitudes = numpy.empty(0)
+        self.airport_indices = {}
+        self.city_indices = {}
+        self.venue_indices = {}
+        self.airport_names = {}
+
+    @staticmethod
+    def load(session, since=None):
+        # Keeps only the forecasts dated since, when given, as older ones are never planned with.
+        world = World()
+        world.load_airports(session.execute(select(Airport.airport_id, Airport.name, Airport.latitude,
+                                                   Airport.longitude).order_by(Airport.airport_id)).all())
+        world.load_cities(session.execute(select(City.city_id, City.city_name, City.latitude,
+                                                 City.longitude).order_by(City.city_id)).all())
+        for venue_id, venue_name, venue_type in session.execute(
+                select(Venue.venue_id, Venue.venue_name, Venue.venue_type).order_by(Venue.venue_id)):
+            world.venue_indices[venue_id] = len(world.venues)
+            world.venues.append(WorldVenue(world, len(world.venues), venue_id, venue_name, venue_type))
+        for airport_id, city_id in session.execute(
+                select(AirportCity.airport_id, AirportCity.city_id).order_by(AirportCity.airport_id,
+                                                                             AirportCity.city_id)):
+            world.airports[world.airport_indices[airport_id]].city_indices.append(world.city_indices[city_id])
+            world.cities[world.city_indices[city_id]].airport_indices.append(world.airport_indices[airport_id])
+        for city_id, venue_id in session.execute(
+                select(CityVenue.city_id, CityVenue.venue_id).order_by(CityVenue.city_id, CityVenue.venue_id)):
+            world.cities[world.city_indices[city_id]].venue_indices.append(world.venue_indices[venue_id])
+        columns = [getattr(Condition, column) for column in CONDITION_COLUMNS]
+        forecasts = select(*columns).where(Condition.city_id.isnot(None) | Condition.airport_id.isnot(None))
+        if since is not None:
+            forecasts = forecasts.where(Condition.date >= since)
+        for row in session.execute(forecasts.order_by(Condition.condition_id)):
+            forecast = WorldCondition(**row._mapping)
+            if forecast.city_id is not None:
+                world.cities[world.city_indices[forecast.city_id]].conditions.append(forecast)
+            else:
+                world.airports[world.airport_indices[forecast.airport_id]].conditions.append(forecast)
+        for row in session.execute(select(VenueCondition.venue_id, *columns).join(
+                Condition, Condition.condition_id == VenueCondition.condition_id).order_by(VenueCondition.venue_id)):
+            values = dict(row._mapping)
+            venue = world.venues[world.venue_indices[values.pop('venue_id')]]
+            if venue.requirement_index is None:
+                venue.requirement_index = len(world.requirements)
+                world.requirements.append(WorldCondition(**values))
+        return world
+
+    @staticmethod
+    def cached(session, path, since=None):
+        # Maps the snapshot at path when it was written from the same table contents and forecast dates, and rewrites
+        # it otherwise.
+        fingerprint = world_fingerprint(session, since)
+        world = World.open(path, fingerprint)
+        if world is None:
+            world = World.load(session, since)
+            world.save(path, fingerprint)
+        return world
+
+    def save(self, path, fingerprint):
+        arrays = self.to_arrays()
+        layout = {}
+        position = 0
+        for name, array in arrays.items():
+            position = aligned(position)
+            layout[name] = [dtype_to_descr(array.dtype), list(array.shape), position]
+            position += array.nbytes
+        header = json.dumps({'fingerprint': fingerprint, 'arrays': layout, 'strings': {
+            'airport_names': [airport.name for airport in self.airports],
+            'city_names': [city.city_name for city in self.cities],
+            'venue_names': [venue.venue_name for venue in self.venues],
+            'venue_types': [venue.venue_type for venue in self.venues]
+        }}).encode('UTF8')
+        start = aligned(len(SNAPSHOT_MAGIC) + 8 + len(header))
+        # Written beside the old snapshot and moved over it, so a reader never maps half a file.
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as snapshot:
+            snapshot.write(SNAPSHOT_MAGIC + struct.pack('<II', SNAPSHOT_VERSION, len(header)) + header)
+            for name, array in arrays.items():
+                snapshot.seek(start + layout[name][2])
+                snapshot.write(array.tobytes())
+            snapshot.truncate(start + position)
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def open(path, fingerprint=None):
+        # Returns None when there is no snapshot, it has another format version or it was taken of other contents.
+        try:
+            with open(path, 'rb') as snapshot:
+                prefix = snapshot.read(len(SNAPSHOT_MAGIC) + 8)
+                if len(prefix) < len(SNAPSHOT_MAGIC) + 8 or not prefix.startswith(SNAPSHOT_MAGIC):
+                    return None
+                version, header_length = struct.unpack('<II', prefix[len(SNAPSHOT_MAGIC):])
+                if version != SNAPSHOT_VERSION:
+                    return None
+                header = json.loads(snapshot.read(header_length).decode('UTF8'))
+        except OSError:
+            return None
+        if fingerprint is not None and header['fingerprint'] != fingerprint:
+            return None
+        start = aligned(len(SNAPSHOT_MAGIC) + 8 + header_length)
+        mapped = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        arrays = {}
+        for name, (descr, shape, offset) in header['arrays'].items():
+            dtype = descr_to_dtype(descr)
+            size = dtype.itemsize * int(numpy.prod(shape))
+            arrays[name] = mapped[start + offset:start + offset + size].view(dtype).reshape(shape)
+        return World.from_arrays(arrays, header['strings'])
+
+    def to_arrays(self):
+        airport_city_offsets, airport_city_indices = compressed_rows(
+            [airport.city_indices for airport in self.airports])
+        city_airport_offsets, city_airport_indices = compressed_rows([city.airport_indices for city in self.cities])
+        city_venue_offsets, city_venue_indices = compressed_rows([city.venue_indices for city in self.cities])
+        forecast_offsets = list_offsets([place.conditions for place in self.airports + self.cities])
+        return {
+            'airport_ids': numpy.array([airport.airport_id for airport in self.airports], dtype='<i8'),
+            'airport_latitudes': self.airport_latitudes.astype('<f8'),
+            'airport_longitudes': self.airport_longitudes.astype('<f8'),
+            'airport_city_offsets': airport_city_offsets,
+            'airport_city_indices': airport_city_indices,
+            'airport_forecast_offsets': forecast_offsets[:len(self.airports) + 1],
+            'city_ids': numpy.array([city.city_id for city in self.cities], dtype='<i8'),
+            'city_latitudes': self.city_latitudes.astype('<f8'),
+            'city_longitudes': self.city_longitudes.astype('<f8'),
+            'city_airport_offsets': city_airport_offsets,
+            'city_airport_indices': city_airport_indices,
+            'city_venue_offsets': city_venue_offsets,
+            'city_venue_indices': city_venue_indices,
+            'city_forecast_offsets': forecast_offsets[len(self.airports):],
+            'venue_ids': numpy.array([venue.venue_id for venue in self.venues], dtype='<i8'),
+            'venue_requirements': numpy.array([-1 if venue.requirement_index is None else venue.requirement_index
+                                               for venue in self.venues], dtype='<i4'),
+            'requirements': numpy.array([encode_condition(requirement) for requirement in self.requirements],
+                                        dtype=CONDITION_DTYPE),
+            'forecasts': numpy.array([encode_condition(forecast) for place in self.airports + self.cities
+                                      for forecast in place.conditions], dtype=CONDITION_DTYPE)
+        }
+
+    @staticmethod
+    def from_arrays(arrays, strings):
+        world = World()
+        world.airport_latitudes = arrays['airport_latitudes']
+        world.airport_longitudes = arrays['airport_longitudes']
+        world.city_latitudes = arrays['city_latitudes']
+        world.city_longitudes = arrays['city_longitudes']
+        forecasts = arrays['forecasts']
+        offsets = arrays['airport_city_offsets'].tolist()
+        forecast_offsets = arrays['airport_forecast_offsets'].tolist()
+        for index, (airport_id, name) in enumerate(zip(arrays['airport_ids'].tolist(), strings['airport_names'])):
+            airport = WorldAirport(world, index, airport_id, name)
+            airport.city_indices = arrays['airport_city_indices'][offsets[index]:offsets[index + 1]]
+            airport.forecast_rows = forecasts[forecast_offsets[index]:forecast_offsets[index + 1]]
+            airport.loaded_conditions = None
+            world.airports.append(airport)
+            world.airport_indices[airport_id] = index
+            world.airport_names[name] = airport
+        airport_offsets = arrays['city_airport_offsets'].tolist()
+        venue_offsets = arrays['city_venue_offsets'].tolist()
+        forecast_offsets = arrays['city_forecast_offsets'].tolist()
+        for index, (city_id, city_name) in enumerate(zip(arrays['city_ids'].tolist(), strings['city_names'])):
+            city = WorldCity(world, index, city_id, city_name)
+            city.airport_indices = arrays['city_airport_indices'][airport_offsets[index]:airport_offsets[index + 1]]
+            city.venue_indices = arrays['city_venue_indices'][venue_offsets[index]:venue_offsets[index + 1]]
+            city.forecast_rows = forecasts[forecast_offsets[index]:forecast_offsets[index + 1]]
+            city.loaded_conditions = None
+            world.cities.append(city)
+            world.city_indices[city_id] = index
+        world.requirements = [decode_condition(row) for row in arrays['requirements'].tolist()]
+        for index, (venue_id, venue_name, venue_type, requirement_index) in enumerate(zip(
+                arrays['venue_ids'].tolist(), strings['venue_names'], strings['venue_types'],
+                arrays['venue_requirements'].tolist())):
+            venue = WorldVenue(world, index, venue_id, venue_name, venue_type)
+            venue.requirement_index = None if requirement_index == -1 else requirement_index
+            world.venues.append(venue)
+            world.venue_indices[venue_id] = index
+        return world
+
+    def load_airports(self, rows):
+        for airport_id, name, _, _ in rows:
+            self.airport_indices[airport_id] = len(self.airports)
+            self.airports.append(WorldAirport(self, len(self.airports), airport_id, name))
+            self.airport_names[name] = self.airports[-1]
+        self.airport_latitudes = numpy.array([row[2] for row in rows], dtype=float)
+        self.airport_longitudes = numpy.array([row[3] for row in rows], dtype=float)
+
+    def load_cities(self, rows):
+        for city_id, city_name, _, _ in rows:
+            self.city_indices[city_id] = len(self.cities)
+            self.cities.append(WorldCity(self, len(self.cities), city_id, city_name))
+        self.city_latitudes = numpy.array([row[2] for row in rows], dtype=float)
+        self.city_longitudes = numpy.array([row[3] for row in rows], dtype=float)
+
+    def airport(self, airport_id):
+        return self.airports[self.airport_indices[airport_id]]
+
+    def airport_named(self, name):
+        if name not in self.airport_names:
+            raise NoResultFound(f'No airport is named {name}')
+        return self.airport_names[name]